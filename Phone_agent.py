@@ -16,29 +16,504 @@
 #   (Note: test invocation [-t] We will not call out. Better used with the '-d' [debug] option as well, as shown here)
 # /opt/tools/phone_agent/Phone_Agent.py -dt /opt/tools/phone_agent/Phone_Agent.conf '2018-09-14T09:00:00-08:00' 0
 #
+# DAEMON Invocation (instead of cron: wakes up at each handoff, refreshes the schedule hourly):
+# /opt/tools/phone_agent/Phone_Agent.py --daemon /opt/tools/phone_agent/Phone_Agent.conf now now >> /opt/tools/phone_agent/Phone_Agent.log 2>&1
+#
 ################################################################################
 
-import  os, sys, argparse, commands, time
-import  re, json, requests
-import  logging,  logging.config
+import  time
+STARTED = time.time()   ### For --profile-startup ...
+
+import  os, sys, argparse, calendar, fcntl
+import  re, json, random
+import  importlib
+import  atexit
+import  logging,  logging.config, logging.handlers
+import  gzip, glob, shutil, tempfile
+import  functools
+import  contextlib
 import  socket
+import  BaseHTTPServer
+import  SocketServer
+import  urlparse
+import  bisect
+import  math
+import  hmac
+import  hashlib
+import  collections
+import  sqlite3
+import  threading
 import  ConfigParser
+import  cPickle
+import  Queue
 import  datetime
-import  dateutil.parser
-import  boto
 
-from    dateutil.relativedelta  import *
-from    pytz                    import timezone
-from    twilio.rest             import TwilioRestClient
-from    urllib                  import quote_plus
+IMPORTED = time.time()
+
+################################################################################
+class StartupProfile(object):
+    """ Time spent in each import and init phase of the run, reported on exit with --profile-startup """
+
+    def __init__(self, started, imported):
+        self.phases = [("import (standard library)", imported - started, 0)]   ### (phase, seconds, nesting depth) ...
+        self.last   = imported
+        self.lazy   = 0     ### Seconds of the top level lazy loads since the last mark ...
+        self.lock   = threading.Lock()
+        self.local  = threading.local()
+
+    def mark(self, phase):
+        """ Close 'phase', which started at the previous mark (less the lazy loads done meanwhile, reported apart) """
+        now = time.time()
+        with self.lock:
+            self.phases.append((phase, now - self.last - self.lazy, 0))
+            self.last = now
+            self.lazy = 0
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """ Time a phase on its own (lazy loads): one started within another is a sub-phase of it, not counted twice """
+        depth = getattr(self.local, 'depth', 0)
+        with self.lock:
+            index = len(self.phases)
+            self.phases.append((phase, 0, depth))
+        self.local.depth = depth + 1
+        started = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - started
+            self.local.depth = depth
+            with self.lock:
+                self.phases[index] = (phase, seconds, depth)
+                if depth == 0:
+                    self.lazy += seconds
+
+    def report(self):
+        print >> sys.stderr, "\nStartup profile:"
+        for phase, seconds, depth in self.phases:
+            print >> sys.stderr, "  %-40s %8.1f ms" % ("  " * depth + phase, seconds * 1000)
+        print >> sys.stderr, "  %-40s %8.1f ms" % ("total", sum(seconds for phase, seconds, depth in self.phases if not depth) * 1000)
+
+startup = StartupProfile(STARTED, IMPORTED)
+
+################################################################################
+class Lazy(object):
+    """ Stand-in for a module or an API client, built by 'factory' on first attribute access: a run which only finds
+        the same person still on call never pays for the SES/Twilio imports and connections """
+
+    lock = threading.RLock()
+
+    def __init__(self, factory, what):
+        self.__dict__.update(factory=factory, what=what, target=None)
+
+    def __getattr__(self, attr):
+        if self.target is None:
+            with self.lock:
+                if self.target is None:
+                    with startup.timed("%s (lazy)" % self.what):
+                        self.__dict__['target'] = self.factory()
+        return getattr(self.target, attr)
+
+################################################################################
+def lazy_import(name, *submodules):
+    """ Lazy module 'name', importing its 'submodules' along with it """
+
+    def load():
+        for module in (name,) + submodules:
+            importlib.import_module(module)
+        return sys.modules[name]
+    return Lazy(load, "import %s" % name)
+
+requests = lazy_import('requests', 'requests.adapters')
+dateutil = lazy_import('dateutil', 'dateutil.parser', 'dateutil.tz')
+pytz     = lazy_import('pytz')
+boto     = lazy_import('boto')
+twilio   = lazy_import('twilio', 'twilio.rest')
+urllib   = lazy_import('urllib')
+numpy    = lazy_import('numpy')     ### Optional: batched timestamp parsing and quiet hours, see vectorized() ...
+
+NUMPY   = None      ### NumPy installed? Found out on the first big batch ...
+BATCH   = 256       ### Smaller batches are done in pure Python: importing NumPy (~70ms) costs more than it saves ...
+tzcache = {}        ### Building a tz object for every parsed timestamp costs more than the parsing itself ...
+
+def tzlocal():
+    key = ('local',) + tuple(time.tzname)   ### ... a new one after time.tzset() though
+    if key not in tzcache:
+        tzcache[key] = dateutil.tz.tzlocal()
+    return tzcache[key]
+
+def tzutc():
+    if 'utc' not in tzcache:
+        tzcache['utc'] = dateutil.tz.tzutc()
+    return tzcache['utc']
+
+def tzoffset(seconds):
+    if not seconds:
+        return tzutc()
+    if seconds not in tzcache:
+        tzcache[seconds] = dateutil.tz.tzoffset(None, seconds)
+    return tzcache[seconds]
+
+def timezone(name):
+    return pytz.timezone(name)
+
+def vectorized(count):
+    """ True if a batch of 'count' timestamps is parsed and classified as arrays: a big enough one, with NumPy installed """
+    global NUMPY
+    if count < BATCH:
+        return False
+    if NUMPY is None:
+        try:
+            NUMPY = bool(numpy.__name__)
+        except ImportError:
+            NUMPY = False
+    return NUMPY
+
+CALL_FINAL   = ('completed', 'busy', 'failed', 'no-answer', 'canceled')    ### Twilio statuses of a call which ended ...
+CALL_REACHED = ('completed', 'busy', 'no-answer')                          ### ... and of a call which rang the person
+
+args    = argparse.Namespace(debug=False, test=False, daemon=False, lookahead=8)    ### Until setup() is called ...
+alogger = logging.getLogger("phone_ctlr_log")
+clogger = logging.getLogger("console_log")
+store   = None      ### OnCallStore of the HTTP endpoint ...
+alerts  = None      ### AlertQueue, once setup() opened it ...
+leader  = None      ### LeaderElection, with [ha] enabled ...
+quiet   = None      ### QuietHours of the [quiet_hours] section ...
+planner = None      ### HandoffPlanner of the upcoming handoffs ...
+events  = logging.getLogger("phone_ctlr_events")
+context = threading.local()     ### Team of the running thread, stamped on its structured events ...
+run_id  = "%08x%04x" % (int(STARTED), os.getpid() % 0x10000)
+wakeups = {}        ### Schedule id -> [threading.Event, ...] set when the webhook notifies a change ...
+
+ALERT_RESERVE = 15     ### Seconds of the run budget kept for the alert email ...
+COURTESY_MIN  = 30     ### ... needed to bother placing the confirmation calls
+PLAN_MIN      = 30     ### ... and to plan the next handoffs ahead
+HANDOFF_TRIES = 3      ### Daemon: attempts at a failing handoff, a minute apart (as many as the overlapping cron windows gave)
+
+################################################################################
+class QueueHandler(logging.Handler):
+    """ Hand the records over to the QueueListener thread for its 'handlers': the caller never waits on a disk, syslog
+        or console write. Records are dropped (and counted) rather than blocking when the queue is full """
+
+    def __init__(self, queue, handlers):
+        logging.Handler.__init__(self)
+        self.queue    = queue
+        self.handlers = handlers
+        self.dropped  = 0
+
+    def prepare(self, record):
+        """ Render the message and stamp the team of the calling thread, before the record changes thread """
+        record.msg  = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        team = getattr(context, 'team', None)
+        record.team     = team and team.name
+        record.sched_id = team and team.schedule_id
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait((self.handlers, self.prepare(record)))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(object):
+    """ Background thread writing the queued records to their handlers """
+
+    def __init__(self, queue):
+        self.queue  = queue
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            handlers, record = item
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self, timeout=5):
+        """ Flush the queued records (at exit) """
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+def local_isotime(ts):
+    """ ISO 8601 local time of the 'ts' epoch, with its UTC offset """
+
+    local  = time.localtime(ts)
+    offset = -(local.tm_isdst and time.altzone or time.timezone) // 60
+    return time.strftime('%Y-%m-%dT%H:%M:%S', local) + "%s%02d%02d" % (offset < 0 and '-' or '+', abs(offset) // 60, abs(offset) % 60)
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line: time, level, run id, team/schedule of the thread, message and the event fields """
+
+    def format(self, record):
+        data = {'ts':       round(record.created, 3),
+                'time':     local_isotime(record.created),
+                'level':    record.levelname,
+                'logger':   record.name,
+                'run':      run_id,
+                'team':     getattr(record, 'team', None),
+                'sched_id': getattr(record, 'sched_id', None),
+                'msg':      record.getMessage()}
+        data.update(getattr(record, 'event', None) or {})
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, sort_keys=True, default=str)
+
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """ Log file rolled over once it reaches 'maxBytes' or at the end of each 'hours' period (local time), whichever
+        comes first. The rolled-over files are gzipped (<file>.<timestamp>.gz) and the 'backupCount' latest are kept
+        (all of them with 0) """
+
+    def __init__(self, filename, maxBytes=0, hours=24, backupCount=30):
+        logging.handlers.RotatingFileHandler.__init__(self, filename, maxBytes=int(maxBytes), backupCount=int(backupCount), delay=True)
+        self.interval = int(float(hours) * 3600)
+        self.period   = self.period_of(os.path.exists(filename) and os.stat(filename).st_mtime or time.time())
+
+    def period_of(self, ts):
+        """ Number of the rotation period of the 'ts' epoch (periods are aligned on local midnight) """
+        local = ts - (time.localtime(ts).tm_isdst and time.altzone or time.timezone)
+        return self.interval and int(local // self.interval) or 0
+
+    def shouldRollover(self, record):
+        if self.period != self.period_of(record.created):
+            return 1
+        return logging.handlers.RotatingFileHandler.shouldRollover(self, record)
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename):
+            rolled = "%s.%s" % (self.baseFilename, time.strftime('%Y%m%dT%H%M%S', time.localtime(os.stat(self.baseFilename).st_mtime)))
+            while os.path.exists(rolled + '.gz'):
+                rolled += '_'
+            os.rename(self.baseFilename, rolled)
+            with open(rolled, 'rb') as f_in:
+                with gzip.open(rolled + '.gz', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+            os.remove(rolled)
+            if self.backupCount > 0:    ### 0: nothing pruned, as with RotatingFileHandler ...
+                backups = sorted(glob.glob(self.baseFilename + '.*.gz'))
+                for old in backups[:max(0, len(backups) - self.backupCount)]:
+                    os.remove(old)
+        self.period = self.period_of(time.time())
+
+################################################################################
+class Metrics(object):
+    """ Counters, gauges and histograms of the agent, rendered in the Prometheus text format. Samples are keyed by
+        metric name and labels; every metric is declared first with describe() """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.meta    = {}   ### name -> (type, help, buckets)
+        self.samples = {}   ### (name, labels) -> value, or [bucket counts, sum, count] for the histograms
+
+    def describe(self, name, kind, help, buckets=BUCKETS):
+        self.meta[name] = (kind, help, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.samples[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key     = (name, tuple(sorted(labels.items())))
+        buckets = self.meta[name][2]
+        with self.lock:
+            counts, total, count = self.samples.get(key) or ([0] * len(buckets), 0.0, 0)
+            self.samples[key] = ([c + (value <= b) for c, b in zip(counts, buckets)], total + value, count + 1)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """ Observe the duration of the 'with' block in the 'name' histogram """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+
+    def merge(self, samples):
+        """ Add the samples of an earlier run (gauges keep the latest value) """
+        with self.lock:
+            for key, value in samples.items():
+                kind = self.meta.get(key[0], (None,))[0]
+                mine = self.samples.get(key)
+                if kind == 'counter':
+                    self.samples[key] = (mine or 0) + value
+                elif kind == 'histogram' and len(value[0]) == len(self.meta[key[0]][2]):
+                    mine = mine or ([0] * len(value[0]), 0.0, 0)
+                    self.samples[key] = ([a + b for a, b in zip(mine[0], value[0])], mine[1] + value[1], mine[2] + value[2])
+                elif kind == 'gauge' and mine is None:
+                    self.samples[key] = value
+
+    def render(self):
+        """ The Prometheus text exposition of all the samples """
+        with self.lock:
+            samples = sorted(self.samples.items())
+        lines = []
+        for name in sorted(set(key[0] for key, value in samples)):
+            kind, help, buckets = self.meta[name]
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (n, labels), value in samples:
+                if n != name:
+                    continue
+                if kind != 'histogram':
+                    lines.append("%s%s %s" % (name, prom_labels(labels), value))
+                    continue
+                counts, total, count = value
+                for bound, c in zip(buckets, counts):
+                    lines.append("%s_bucket%s %s" % (name, prom_labels(labels + (('le', repr(float(bound))),)), c))
+                lines.append("%s_bucket%s %s" % (name, prom_labels(labels + (('le', '+Inf'),)), count))
+                lines.append("%s_sum%s %s" % (name, prom_labels(labels), repr(total)))
+                lines.append("%s_count%s %s" % (name, prom_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def save(self, path):
+        """ Add this process' samples to those kept next to the 'path' textfile, and rewrite the textfile
+            (for the node_exporter textfile collector): the counters and histograms of the cron runs add up """
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path + '.state', 'rb') as f:
+                    self.merge(cPickle.load(f))
+            except Exception:   ### First run, or an unreadable state: start over ...
+                pass
+            for target, write in ((path + '.state', lambda f: cPickle.dump(self.samples, f, cPickle.HIGHEST_PROTOCOL)),
+                                  (path, lambda f: f.write(self.render()))):
+                with open(target + '.tmp', 'wb') as f:
+                    write(f)
+                os.rename(target + '.tmp', target)
+
+################################################################################
+def prom_labels(labels):
+    """ {k="v",...} rendering of the (key, value) label pairs """
+
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+metrics = Metrics()
+metrics.describe('phone_agent_phase_seconds',            'histogram', "Duration of each phase of a run (schedule fetch, Phone_Ctlr calls, person calls, emails, ...)")
+metrics.describe('phone_agent_pagerduty_requests_total', 'counter',   "PagerDuty API requests, by HTTP status ('error' when no response)")
+metrics.describe('phone_agent_pagerduty_retries_total',  'counter',   "PagerDuty API requests retried")
+metrics.describe('phone_agent_twilio_create_seconds',    'histogram', "Duration of the Twilio calls.create requests")
+metrics.describe('phone_agent_calls_total',              'counter',   "Calls placed, by kind and final status")
+metrics.describe('phone_agent_sleep_seconds_total',      'counter',   "Time spent sleeping, by reason")
+metrics.describe('phone_agent_alerts_total',             'counter',   "Alerts queued, by kind")
+metrics.describe('phone_agent_handoff_latency_seconds',  'histogram', "From the scheduled shift boundary to the switch (Phone_Ctlr switched, or confirmed to both people); negative ahead of the boundary",
+                 (-480, -300, -120, -60, 0, 30, 60, 120, 300, 600, 900, 1800, 3600))
+metrics.describe('phone_agent_last_run_timestamp_seconds', 'gauge',   "End of the last run")
+metrics.describe('phone_agent_leader',                   'gauge',     "1 while this agent holds the HA lease, 0 on a standby")
+metrics.describe('phone_agent_plans_total',              'counter',   "Handoff plans built ahead of time, by status (ok or failed)")
+
+################################################################################
+class Clock(object):
+    """ The time the switchover logic reads and sleeps on: the system clock, or a VirtualClock in simulations """
+
+    def time(self):
+        return time.time()
+
+    def now(self, tz=None):
+        return datetime.datetime.now(tz)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class VirtualClock(Clock):
+    """ Simulated time, starting at the 'start' epoch: sleeping moves it forward at once """
+
+    def __init__(self, start=0):
+        self.t = float(start)
+
+    def time(self):
+        return self.t
+
+    def now(self, tz=None):
+        return datetime.datetime.fromtimestamp(self.t, tz)
+
+    def sleep(self, seconds):
+        self.t += max(0, seconds)
+
+clock = Clock()
+
+################################################################################
+def sleep(seconds, reason):
+    """ time.sleep() (on the virtual clock in simulations), accounted for in the metrics """
+
+    metrics.inc('phone_agent_sleep_seconds_total', seconds, reason=reason)
+    clock.sleep(seconds)
+
+################################################################################
+def route_metrics(query):
+    """ GET /metrics: the Prometheus metrics of the process """
+
+    return 200, metrics.render()
+
+################################################################################
+def save_metrics():
+    """ Write the [metrics] textfile at exit """
+
+    path = conf_get('metrics', 'textfile')
+    if path:
+        metrics.set('phone_agent_last_run_timestamp_seconds', int(time.time()))
+        try:
+            metrics.save(path)
+        except (IOError, OSError), e:
+            alogger.warning( "Warning - Unable to write the metrics textfile %s: %s" % (path, e) )
+
+################################################################################
+def event(phase, **fields):
+    """ Log the structured event of a phase (JSON event log), stamped with the run id and the thread's team """
+
+    events.info(phase, extra={'event': dict(fields, phase=phase)})
+
+################################################################################
+def timed(phase):
+    """ Decorator logging a structured 'phase' event for every call of the function, with its duration and outcome,
+        and timing it in the phone_agent_phase_seconds histogram """
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*a, **kw):
+            started = time.time()
+            try:
+                result = func(*a, **kw)
+            except BaseException, e:
+                metrics.observe('phone_agent_phase_seconds', time.time() - started, phase=phase, ok='false')
+                event(phase, seconds=round(time.time() - started, 3), ok=False, error="%s %s" % (type(e).__name__, e))
+                raise
+            metrics.observe('phone_agent_phase_seconds', time.time() - started, phase=phase, ok='true')
+            event(phase, seconds=round(time.time() - started, 3), ok=True)
+            return result
+        return wrapper
+    return decorate
 
 ################################################################################
 def setupLogging(loglevel=logging.INFO):
     """ Set up the Dictionary-Based Configuration For Logging """
 
-    # The following configures two loggers, the root logger and a logger named "phone_ctlr_log". Messages sent to the
-    # root logger will be sent to the system log using the syslog protocol, and messages to the "phone_ctlr_log" logger will
-    # be written to the Phone_Agent.log file which will be rotated once the log reaches 1Mb.
+    # The following configures the root logger and the "phone_ctlr_log", "console_log" and "phone_ctlr_events" loggers.
+    # Messages sent to the root logger will be sent to the system log using the syslog protocol, messages to the
+    # "phone_ctlr_log" logger will be written to the Phone_Agent.log file, and every logger but the root one also writes
+    # JSON events to the Phone_Agent.events.json file. Both files are rotated by size and by day, and gzipped.
+    # All the handlers run in a single background thread behind a queue: logging never blocks the caller.
 
     configdict = {
         'version': 1,                        # Configuration schema in use; must be 1 for now
@@ -56,16 +531,26 @@ def setupLogging(loglevel=logging.INFO):
                 'datefmt': '%Y%m%dT%H%M%S.%Z' },
             'custom': {
                 'format' : '%(asctime)s - %(message)s',
-                'datefmt': '%Y-%m-%dT%H:%M:%S.%Z' }         ### Ex,: 2038-01-01T05:05:02
+                'datefmt': '%Y-%m-%dT%H:%M:%S.%Z' },        ### Ex,: 2038-01-01T05:05:02
+            'json': {
+                '()'     : JsonFormatter }
         },
 
-        'handlers': {'applog': {'class': 'logging.handlers.RotatingFileHandler',
-                                'filename': '/opt/tools/phone_agent/Phone_Agent.log',
+        'handlers': {'applog': {'()': CompressedRotatingFileHandler,
+                                'filename': conf_get('logging', 'path', '/opt/tools/phone_agent/Phone_Agent.log'),
                                #'filename': 'Phone_Agent.log',
-                                'backupCount': 3,
+                                'backupCount': conf_get('logging', 'backups', 30),
                                 'formatter': 'custom',
                                 'level': 'INFO',
-                                'maxBytes': 1024*1024},
+                                'hours': conf_get('logging', 'rotate_hours', 24),
+                                'maxBytes': conf_get('logging', 'max_bytes', 10*1024*1024)},
+                     'events': {'()': CompressedRotatingFileHandler,
+                                'filename': conf_get('logging', 'events', '/opt/tools/phone_agent/Phone_Agent.events.json'),
+                                'backupCount': conf_get('logging', 'backups', 30),
+                                'formatter': 'json',
+                                'level': 'DEBUG',
+                                'hours': conf_get('logging', 'rotate_hours', 24),
+                                'maxBytes': conf_get('logging', 'max_bytes', 10*1024*1024)},
                      'conlog': {'class': 'logging.StreamHandler',
                                 'formatter': 'console',
                                #'stream': 'console',
@@ -77,10 +562,15 @@ def setupLogging(loglevel=logging.INFO):
         # Specify all the subordinate loggers
         'loggers': {
                     'phone_ctlr_log': {
-                                'handlers': ['applog']
+                                'handlers': ['applog', 'events']
                     },
                     'console_log': {
-                                'handlers': ['conlog']
+                                'handlers': ['conlog', 'events']
+                    },
+                    'phone_ctlr_events': {
+                                'handlers': ['events'],
+                                'propagate': False,
+                                'level': 'INFO'
                     }
         },
         # Specify properties of the root logger
@@ -92,36 +582,75 @@ def setupLogging(loglevel=logging.INFO):
     # Set up configuration
     logging.config.dictConfig(configdict)
 
+    # Move every handler behind the queue ...
+    queue = Queue.Queue(int(conf_get('logging', 'queue_size', 10000)))
+    for logger in (logging.getLogger(), logging.getLogger("phone_ctlr_log"), logging.getLogger("console_log"), events):
+        logger.handlers = [QueueHandler(queue, logger.handlers)]
+    atexit.register(QueueListener(queue).stop)
+
 
 ################################################################################
-def phone_controller(client_account, client_token, mode, extension, debug=False, test_mode=False):
-    """ Call the Phone_Ctlr remote setup line to en/disable call forwarding for the specific extension """
+def conf_get(section, option, default=None):
+    """ Read an optional value from the config file, falling back to 'default' """
+
+    try:
+        return s.get(section, option)
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return default
+
+################################################################################
+def phone_ctlr_digits(mode, extension):
+    """ Build the DTMF tones string to send to en/disable Phone_Ctlr for the specific extension """
 
-    #-- Build the DTMF tones string to send to en/disable Phone_Ctlr ...
     phone_ctlr_enable  = "121w%d#%d#"
     phone_ctlr_disable = "122w%d#%d#"
-    if mode == 'enable':  digits =  phone_ctlr_enable  % (extension, extension)
-    if mode == 'disable': digits =  phone_ctlr_disable % (extension, extension)
+    if mode == 'enable':  return phone_ctlr_enable  % (extension, extension)
+    if mode == 'disable': return phone_ctlr_disable % (extension, extension)
+
+def phone_ctlr_batch_digits(commands):
+    """ DTMF tones string of several [(mode, extension), ...] Phone_Ctlr commands, chained with the configured pause
+        ('w' = 0.5 second each) so Phone_Ctlr is ready for the next command """
+
+    pause = conf_get('phone_ctlr', 'pause', 'wwww')
+    return pause.join(phone_ctlr_digits(mode, extension) for mode, extension in commands)   # Example: "121w19876#19876#wwww122w12345#12345#"
+
+################################################################################
+@timed('phone_ctlr_call')
+def phone_controller(client_account, client_token, mode, extension, debug=False, test_mode=False, ctlr_number=None, digits=None):
+    """ Call the Phone_Ctlr remote setup line (the team's 'ctlr_number') to en/disable call forwarding for the specific extension
+        (or to send an already built 'digits' sequence) """
+
+    ctlr_number = ctlr_number or phone_ctlr_number
+
+    #-- Build the DTMF tones string to send to en/disable Phone_Ctlr ...
+    digits = digits or phone_ctlr_digits(mode, extension)
     if args.debug:
         clogger.info( "mode: %-7s, digits: %s" % ( mode, digits) )
 
     if test_mode:
-        clogger.info( "In test mode. We will not be using the phone_controller (%s) function to call out..." % phone_ctlr_number )
+        clogger.info( "In test mode. We will not be using the phone_controller (%s) function to call out..." % ctlr_number )
         return True
     else:
         #-- Call to en/disable Phone_Ctlr ...
         if args.debug:
-            clogger.info( "Calling the Phone_Ctlr control number (%s) with the Twilio client ... digits: %s" % (phone_ctlr_number, digits) )
+            clogger.info( "Calling the Phone_Ctlr control number (%s) with the Twilio client ... digits: %s" % (ctlr_number, digits) )
 
         try:
-            call = client.calls.create(        to  = phone_ctlr_number,
-                                            from_  = callerid,
-                                       send_digits = digits,            # Example: "122w19876#19876#"
-                                           timeout = int(10),
-                                               url = "http://twimlets.com/%s/end" % client_account
-            )   # End of call Twiml
+            with metrics.timer('phone_agent_twilio_create_seconds', kind='phone_ctlr'):
+                call = client.calls.create(        to  = ctlr_number,
+                                                from_  = callerid,
+                                           send_digits = digits,            # Example: "122w19876#19876#"
+                                               timeout = int(10),
+                                                   url = "http://twimlets.com/%s/end" % client_account
+                )   # End of call Twiml
         except:
             clogger.error("Unable to complete the call to the Phone Controller.")
+            return None
+
+        #-- Wait for Phone_Ctlr to hang up: the call only counts if it went through ...
+        if track_call(call.sid, "Phone_Ctlr (%s)" % mode, kind='phone_ctlr') is None:
+            clogger.error("The call to the Phone Controller did not complete (sid: %s)." % call.sid)
+            return None
 
 #        call_details_url = 'https://api.twilio.com/2010-04-01/Accounts/%s/Calls/%s.json' % (client_account, call1.sid)
 #        try:
@@ -140,8 +669,15 @@ def phone_controller(client_account, client_token, mode, extension, debug=False,
        #clogger.info( "Sid: %s" % call.sid )
         return call.sid
 
+################################################################################
+def phone_controller_batch(client_account, client_token, commands, debug=False, test_mode=False, ctlr_number=None, digits=None):
+    """ Send several [(mode, extension), ...] Phone_Ctlr commands in a single call (or the already built 'digits'
+        sequence of them), see phone_ctlr_batch_digits(). Timed as a 'phone_ctlr_call' phase by phone_controller() """
+
+    return phone_controller(client_account, client_token, 'batch', None, debug, test_mode, ctlr_number, digits or phone_ctlr_batch_digits(commands))
 
 ################################################################################
+@timed('send_email')
 def send_email(ses, email, error_msg, error_result=None, error_solution=None):
 
     hst_name = str(socket.gethostname())
@@ -161,111 +697,852 @@ def send_email(ses, email, error_msg, error_result=None, error_solution=None):
         return True
 
     except Exception, e:
-        print "Failed to send mail to %s: %s %s" % (email, Exception, e)
         alogger.error( "Failed to send mail to %s: %s %s" % (email, Exception, e) )
         return False
 
 ################################################################################
-def get_phone_numbers(team_member, direction):
-    """ Get the Desk phone number for the Team member (5xxxx) """
+class AlertQueue(object):
+    """ Durable (SQLite) queue of the alert emails. An alert of the same kind and schedule as a pending one is merged
+        into it (counted, latest message kept), and a background thread sends all the pending alerts as a single
+        digest, at most once every 'interval' seconds. Alerts left pending at exit are sent by the next run """
+
+    def __init__(self, path, interval=300):
+        self.path     = path
+        self.interval = int(interval)
+        self.lock     = threading.Lock()
+        self.wake     = threading.Event()
+        self.stopping = False
+        self.thread   = None
+        self.db       = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)  ### Explicit transactions ...
+        self.db.execute("CREATE TABLE IF NOT EXISTS alert_queue (kind TEXT, sched_id TEXT, first INTEGER, last INTEGER, "
+                        "count INTEGER, message TEXT, sent INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS alert_queue_idx ON alert_queue (kind, sched_id, sent)")
+
+    def put(self, kind, message, schedId=None):
+        """ Queue an alert, merged into the pending one of the same kind and schedule if any """
+        now = int(time.time())
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            cursor = self.db.execute("UPDATE alert_queue SET last=?, count=count+1, message=? WHERE kind=? AND sched_id=? AND sent IS NULL",
+                                     (now, message, kind, schedId or ''))
+            if cursor.rowcount == 0:
+                self.db.execute("INSERT INTO alert_queue VALUES (?, ?, ?, ?, 1, ?, NULL)", (kind, schedId or '', now, now, message))
+            self.db.execute("COMMIT")
+        self.wake.set()
+
+    def take(self):
+        """ Claim the pending alerts if the rate limit lets a digest go now. Return (rows, seconds before the next digest may go) """
+        now = int(time.time())
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")  ### Another process sharing the queue must not claim the same alerts ...
+            last = self.db.execute("SELECT MAX(sent) FROM alert_queue").fetchone()[0] or 0
+            rows = []
+            if now >= last + self.interval:
+                rows = self.db.execute("SELECT rowid, kind, sched_id, first, last, count, message FROM alert_queue "
+                                       "WHERE sent IS NULL ORDER BY first").fetchall()
+                if rows:
+                    self.db.execute("UPDATE alert_queue SET sent=? WHERE sent IS NULL AND rowid<=?", (now, max(row[0] for row in rows)))
+                    last = now
+            self.db.execute("DELETE FROM alert_queue WHERE sent<?", (now - 7 * 86400,))
+            self.db.execute("COMMIT")
+        return rows, max(0, last + self.interval - now)
+
+    def release(self, rows):
+        """ Put back alerts whose digest could not be sent """
+        with self.lock:
+            self.db.execute("UPDATE alert_queue SET sent=NULL WHERE rowid IN (%s)" % ",".join("?" * len(rows)), [row[0] for row in rows])
+
+    def flush(self):
+        """ Send the pending alerts as one digest if the rate limit allows. Return the seconds to wait before trying again """
+        rows, wait = self.take()
+        if rows:
+            alogger.info( "Sending %s queued alert(s) in a digest" % len(rows) )
+            sent = send_email(ses, email, alert_digest(rows))
+            event('alert_digest', alerts=len(rows), kinds=sorted(set(row[1] for row in rows)), ok=sent)
+            if not sent:
+                self.release(rows)
+                wait = self.interval
+        return wait or self.interval
+
+    def run(self):
+        while True:
+            try:
+                wait = self.flush()
+            except Exception, e:
+                alogger.error( "Error - Alert queue %s: %s %s" % (self.path, Exception, e) )
+                wait = self.interval
+            if self.stopping:
+                return
+            self.wake.wait(wait)
+            self.wake.clear()
+
+    def start(self):
+        """ Run the sender in the background """
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self, timeout=ALERT_RESERVE):
+        """ Give the sender a last chance to send the queued alerts before the process exits """
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+################################################################################
+def alert_digest(rows):
+    """ Body of the digest email of the queued alert rows """
+
+    parts = []
+    for rowid, kind, schedId, first, last, count, message in rows:
+        parts.append("<p><b>%s%s</b> -- %s time(s), %s to %s</p>\n%s" % (kind, schedId and " (schedule %s)" % schedId or "", count,
+                     time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(first)), time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(last)), message))
+    return "\n<hr />\n".join(parts)
+
+################################################################################
+def alert(kind, error_msg, schedId=None):
+    """ Queue an alert email of 'kind' about schedule 'schedId' (sent right away when there is no queue).
+        Return True once queued """
+
+    if alerts is None:
+        return send_email(ses, email, error_msg)
+    alerts.put(kind, error_msg, schedId)
+    metrics.inc('phone_agent_alerts_total', kind=kind)
+    return True
+
+################################################################################
+Person = collections.namedtuple('Person', 'name user_id desk desk_e164 cell')
+
+################################################################################
+def e164(number):
+    """ E.164 form of a phone number from the config file: +1AAANNNXXXX for a North American number (with or without
+        the leading 1 and any punctuation), kept as is when it already starts with '+'. None if it is not a number """
+
+    digits = re.sub(r'\D', '', str(number))
+    if str(number).strip().startswith('+'):
+        return 8 <= len(digits) <= 15 and '+' + digits or None
+    if len(digits) == 11 and digits.startswith('1'):
+        digits = digits[1:]
+    return len(digits) == 10 and '+1' + digits or None
+
+################################################################################
+class PhoneDirectory(object):
+    """ The people of a team's desk and cell phone sections, validated and normalized once, and indexed by
+        PagerDuty user id ([pagerduty_ids] section) and by name: a renamed PagerDuty user is still found by id """
+
+    def __init__(self, people, errors=()):
+        self.people  = people
+        self.errors  = list(errors)
+        self.by_id   = dict((person.user_id, person) for person in people if person.user_id)
+        self.by_name = dict((person.name.lower(), person) for person in people)
+
+    @classmethod
+    def compile(cls, desk_section, cell_section):
+        """ Build the directory of the desk_section/cell_section sections of the config file. Invalid entries are
+            left out and listed in 'errors' """
+
+        ids    = s.has_section('pagerduty_ids') and dict(s.items('pagerduty_ids')) or {}
+        desks  = s.has_section(desk_section)    and dict(s.items(desk_section))    or {}
+        cells  = s.has_section(cell_section)    and dict(s.items(cell_section))    or {}
+        short_prefix = conf_get('directory', 'short_prefix', '7')         ### Short desk extensions dialable from outside ...
+        long_prefix  = conf_get('directory', 'long_prefix',  '+1408540')  ### ... and what replaces their prefix
+
+        people = []
+        errors = []
+        for name in sorted(set(desks) | set(cells)):
+            desk = desks.get(name, '').strip()
+            cell = e164(cells.get(name, ''))
+            if not desk.isdigit():
+                errors.append("[%s] %s: missing or invalid desk extension '%s'" % (desk_section, name, desk))
+            elif cell is None:
+                errors.append("[%s] %s: missing or invalid cell phone '%s'" % (cell_section, name, cells.get(name, '')))
+            else:
+                people.append(Person(name, ids.get(name), int(desk), desk.startswith(short_prefix) and e164(long_prefix + desk[len(short_prefix):]) or None, cell))
+        return cls(people, errors)
+
+    def lookup(self, user_id=None, name=None):
+        """ The Person of PagerDuty user 'user_id', or named 'name', None if unknown """
+        return self.by_id.get(user_id) or self.by_name.get((name or '').lower())
+
+################################################################################
+def load_directories(teams):
+    """ Attach its PhoneDirectory to each team. The directories are compiled once per change of the config file and
+        kept as a snapshot ([directory] snapshot) which later runs load as is """
 
+    path  = conf_get('directory', 'snapshot', '/opt/tools/phone_agent/Phone_Agent.directory')
+    stamp = (os.path.abspath(args.conf_file), os.stat(args.conf_file).st_mtime)
+    keys  = set((team.desk_section, team.cell_section) for team in teams)
+
+    snapshot = None
     try:
-        desk_phone = int(s.get('desk_phone', team_member))
-        cell_phone = int(s.get('cell_phone', team_member))
-        return (desk_phone, cell_phone)
+        with open(path, 'rb') as f:
+            snapshot = cPickle.load(f)
+        if snapshot.get('stamp') != stamp or not keys <= set(snapshot.get('directories')):
+            snapshot = None
+    except Exception:       ### Missing, unreadable or from an older version: compile it again ...
+        snapshot = None
+
+    if snapshot is None:
+        directories = dict((key, PhoneDirectory.compile(*key)) for key in keys)
+        errors      = sum((directory.errors for directory in directories.values()), [])
+        for error in errors:
+            alogger.error( "Config file: Phone directory: %s" % error )
+        if errors:
+            alert('directory',
+                       "<dl><dt><b>Error:</b></dt><dd>The config file: Phone_Agent.conf has invalid phone directory entries:<br>%s</dd>\
+                        <dt><b>Result:</b></dt><dd>Phone_Ctlr will NOT be switched over to or from these people.</dd>\
+                        <dt><b>Solution:</b></dt><dd>PLS fix the phone numbers in the config file: <i>%s</i></dd></dl>" %
+                            ("<br>".join(errors), os.path.abspath(args.conf_file))
+            )
+        snapshot = {'stamp': stamp, 'directories': dict((key, ([tuple(p) for p in directory.people], directory.errors))
+                                                           for key, directory in directories.items())}
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError), e:
+            alogger.warning( "Warning - Unable to save the phone directory snapshot %s: %s" % (path, e) )
 
-    except Exception, e:
-        alogger.error("Config file: Phone_Agent.conf does not contain a phone number for: %s" % team_member)
-        first_name = team_member.split()[0]
-
-        send_email(ses,
-                   email,
-                   "<dl><dt><b>Error:</b></dt><dd>The config file: Phone_Agent.conf does not contain phone numbers for: %s.</dd>\
-                    <dt><b>Result:</b></dt><dd>Phone_Ctlr was NOT switched over %s %s.</dd>\
-                    <dt><b>Solution:</b></dt><dd>PLS add %s's phone numbers to the config file: <i>%s/Phone_Agent.conf</i></dd></dl>" %
-                        (team_member, direction, first_name, first_name, os.path.dirname(os.path.abspath(__file__)))
-        )
+    for team in teams:
+        people, errors = snapshot['directories'][(team.desk_section, team.cell_section)]
+        team.directory = PhoneDirectory([Person(*p) for p in people], errors)
 
-        sys.exit(1)
+################################################################################
+def epoch(ts):
+    """ Seconds since the epoch for a datetime (naive datetimes are taken as local time) """
+
+    if ts.tzinfo is None or ts.utcoffset() is None:
+        return int(time.mktime(ts.timetuple()))
+    return int(calendar.timegm(ts.utctimetuple()))
 
 ################################################################################
-def get_pd_schedule(schedId, ts_in=None, ts_out=None, debug=False):  # ts_... => Timestamps ...
-    """ Extract the PagerDuty schedule for the specified PD_group for the datetime_range specified by ts_in/ts_out """
+ISO_TIMESTAMP = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6})\d*)?(?:(Z)|([+-])(\d\d):?(\d\d))?$')
+
+def iso_fields(ts):
+    """ (year, month, day, hour, minute, second, microsecond, UTC offset seconds or None) of an ISO-8601 timestamp,
+        None if it is not one """
+
+    match = ISO_TIMESTAMP.match(ts)
+    if match is None:
+        return None
+    f = match.groups()
+    offset = None
+    if f[7]:
+        offset = 0
+    elif f[8]:
+        offset = (f[8] == '-' and -1 or 1) * (int(f[9]) * 3600 + int(f[10]) * 60)
+    return (int(f[0]), int(f[1]), int(f[2]), int(f[3]), int(f[4]), int(f[5]), f[6] and int(f[6].ljust(6, '0')) or 0, offset)
+
+def parse_iso(ts):
+    """ Datetime of a timestamp: PagerDuty's fixed ISO-8601 format through a regular expression and the cached tz
+        objects, anything else through dateutil """
+
+    fields = iso_fields(ts)
+    if fields is None:
+        return dateutil.parser.parse(ts)
+    return datetime.datetime(*fields[:7], tzinfo=fields[7] is not None and tzoffset(fields[7]) or None)
+
+def iso_epoch(ts):
+    """ Seconds since the epoch of a timestamp (see parse_iso), without building any datetime for the fixed format """
+
+    fields = iso_fields(ts)
+    if fields is None or fields[7] is None:
+        return epoch(parse_iso(ts))
+    return calendar.timegm(fields[:6]) - fields[7]
 
-    sch_beg = sch_end = 0
+################################################################################
+def parse_epochs(stamps):
+    """ Seconds since the epoch of a batch of timestamps: an int64 array with NumPy (big batches), a list otherwise.
+        The fixed formats of PagerDuty ('2018-09-14T05:00:00-07:00' and '2018-09-14T12:00:00Z') are parsed as arrays
+        (the dates as datetime64), the other timestamps one by one """
+
+    stamps = list(stamps)
+    if not vectorized(len(stamps)):
+        return [iso_epoch(ts) for ts in stamps]
+
+    raw    = numpy.array(stamps, dtype='S26')   ### One byte more than the longest fixed format: longer ones do not match ...
+    chars  = raw.view('u1').reshape(len(stamps), 26).astype(numpy.int64)
+    epochs = numpy.zeros(len(stamps), dtype=numpy.int64)
+    zulu   = (chars[:, 19] == ord('Z')) & (chars[:, 20] == 0)
+    offset = ((chars[:, 19] == ord('+')) | (chars[:, 19] == ord('-'))) & (chars[:, 22] == ord(':')) & (chars[:, 25] == 0) & (chars[:, 24] != 0)
+    fixed  = (zulu | offset) & ((chars[:, 10] == ord('T')) | (chars[:, 10] == ord(' ')))
+
+    def number(first, digits):
+        value = numpy.zeros(len(stamps), dtype=numpy.int64)
+        for i in xrange(first, first + digits):
+            value = value * 10 + chars[:, i] - ord('0')
+        return value
+
+    if fixed.any():
+        try:
+            days = raw[fixed].astype('S10').astype('datetime64[D]').astype(numpy.int64)
+        except ValueError:  ### Not a date after all: the slow path for all of them ...
+            fixed[:] = False
+        else:
+            sign = numpy.where(chars[:, 19] == ord('-'), -1, 1)
+            secs = number(11, 2) * 3600 + number(14, 2) * 60 + number(17, 2) - \
+                   numpy.where(offset, sign * (number(20, 2) * 3600 + number(23, 2) * 60), 0)
+            epochs[fixed] = days * 86400 + secs[fixed]
+    for i in numpy.flatnonzero(~fixed):
+        epochs[i] = iso_epoch(stamps[i])
+    return epochs
 
-    if args.debug:
-        print "\nEntering function with:                 \nts_in:   %s\nts_out:  %s\n" % (ts_in, ts_out)    # debug
-        print "1-type(ts_in):  ", ; print type(ts_in)   # debug
-        print "1-type(ts_out): ", ; print type(ts_out)  # debug
+################################################################################
+class ScheduleCache(object):
+    """ On-disk (SQLite) cache of the PagerDuty schedule entries.
+
+        Entries are fetched and stored by fixed-size time buckets ('bucket' hours) for each schedule id. A bucket
+        is refreshed from PagerDuty once it is older than 'ttl' minutes or has been invalidated; a stale bucket is
+        still good enough to answer from when PagerDuty cannot be reached.
+    """
+
+    def __init__(self, path, ttl=30, bucket=6):
+        self.path   = path
+        self.ttl    = int(ttl) * 60
+        self.bucket = int(bucket) * 3600
+        self.lock   = threading.Lock()
+        self.db     = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS pd_buckets (sched_id TEXT, since INTEGER, until INTEGER, "
+                        "fetched INTEGER, valid INTEGER, PRIMARY KEY (sched_id, since))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pd_entries (sched_id TEXT, since INTEGER, start INTEGER, "
+                        "end INTEGER, entry TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pd_entries_idx ON pd_entries (sched_id, start)")
+        self.db.commit()
+
+    def buckets(self, ts_in, ts_out):
+        """ (since, until) epochs of the buckets covering the ts_in/ts_out datetimes """
+        first = epoch(ts_in)  - epoch(ts_in)  % self.bucket
+        last  = epoch(ts_out) - epoch(ts_out) % self.bucket
+        return [(b, b + self.bucket) for b in xrange(first, last + 1, self.bucket)]
+
+    def stale(self, schedId, ts_in, ts_out):
+        """ Buckets of the ts_in/ts_out range which are missing, expired or invalidated """
+        stale = []
+        with self.lock:
+            for since, until in self.buckets(ts_in, ts_out):
+                row = self.db.execute("SELECT fetched, valid FROM pd_buckets WHERE sched_id=? AND since=?",
+                                      (schedId, since)).fetchone()
+                if row is None or not row[1] or row[0] + self.ttl <= time.time():
+                    stale.append((since, until))
+        return stale
+
+    def covers(self, schedId, ts_in, ts_out):
+        """ True if every bucket of the ts_in/ts_out range was fetched at least once (fresh or not) """
+        with self.lock:
+            for since, until in self.buckets(ts_in, ts_out):
+                if self.db.execute("SELECT 1 FROM pd_buckets WHERE sched_id=? AND since=?", (schedId, since)).fetchone() is None:
+                    return False
+        return True
 
-    ############################################################################
-    # Use current time if timestamp range not specified ...
-    ############################################################################
-    now1 = dateutil.parser.parse(commands.getoutput("date +%Y-%m-%dT%H:%M:%S%:z"))
-    if args.debug:
-        print "Now1: %s" % now1
-       #print "Now1: %s" % now1.strftime("%Y-%m-%dT%H:%M:%S%z")   # debug
+    def store(self, schedId, since, until, entries):
+        """ Replace the content of a bucket with freshly fetched entries """
+        with self.lock:
+            self.db.execute("DELETE FROM pd_entries WHERE sched_id=? AND since=?", (schedId, since))
+            self.db.executemany("INSERT INTO pd_entries VALUES (?, ?, ?, ?, ?)",
+                                [(schedId, since, int(start), int(end), json.dumps(e)) for e, start, end in
+                                 zip(entries, parse_epochs(e.get('start') for e in entries), parse_epochs(e.get('end') for e in entries))])
+            self.db.execute("INSERT OR REPLACE INTO pd_buckets VALUES (?, ?, ?, ?, 1)", (schedId, since, until, int(time.time())))
+            self.db.commit()
+
+    def merge(self, schedId, ts_in, ts_out, entries):
+        """ Replace the cached entries overlapping the ts_in/ts_out range (within a bucket) with the freshly fetched
+            entries of that range. The rest of the buckets, and their age, are left as they are """
+        t_in, t_out = epoch(ts_in), epoch(ts_out)
+        rows = zip(entries, parse_epochs(e.get('start') for e in entries), parse_epochs(e.get('end') for e in entries))
+        with self.lock:
+            for since, until in self.buckets(ts_in, ts_out):
+                self.db.execute("DELETE FROM pd_entries WHERE sched_id=? AND since=? AND start<? AND end>?", (schedId, since, t_out, t_in))
+                self.db.executemany("INSERT INTO pd_entries VALUES (?, ?, ?, ?, ?)",
+                                    [(schedId, since, int(start), int(end), json.dumps(e)) for e, start, end in rows
+                                     if start < until and end > since])
+            self.db.commit()
+
+    def invalidate(self, schedId, ts_in=None, ts_out=None):
+        """ Force a refresh of the buckets of the ts_in/ts_out range (the whole schedule by default) """
+        since = ts_in  and epoch(ts_in)  or 0
+        until = ts_out and epoch(ts_out) or 2**31
+        with self.lock:
+            self.db.execute("UPDATE pd_buckets SET valid=0 WHERE sched_id=? AND until>? AND since<=?", (schedId, since, until))
+            self.db.commit()
+
+    def entries(self, schedId, ts_in, ts_out):
+        """ Cached entries overlapping the ts_in/ts_out range, sorted by start time """
+        seen    = set()
+        entries = []
+        with self.lock:
+            rows = self.db.execute("SELECT start, entry FROM pd_entries WHERE sched_id=? AND start<? AND end>? ORDER BY start",
+                                   (schedId, epoch(ts_out), epoch(ts_in))).fetchall()
+        for start, entry in rows:
+            entry = json.loads(entry)
+            key   = (start, entry.get('user').get('id'))
+            if key not in seen:     ### Shifts spanning several buckets are stored once per bucket ...
+                seen.add(key)
+                entries.append(entry)
+        return entries
 
-    ### ts_in is null or == '0' or == 'now' ...
-    if not ts_in  or ts_in.lower()  == 'now' or ts_in  == '0':
-        ts_in  = now1
-        if args.debug: print "\n2-Timestamps=='now' or 0 or null, using current time:\nts_in:  %s\n" % (ts_in) # debug
-    else: ts_in = dateutil.parser.parse(ts_in)
+################################################################################
+def pd_chunks(ts_in, ts_out):
+    """ (since, until) epochs of the chunks the ts_in/ts_out range is fetched by: the schedule cache buckets, or
+        'chunk_hours' slices of the range without the cache """
 
-    ### ts_out is null or == '0' or 'now' ...
-    if not ts_out or ts_out.lower() == 'now' or ts_out == '0':
-        ts_out = now1
-        if args.debug: print "\n2-Timestamps=='now' or 0 or null, using current time:\nts_out: %s\n" % (ts_out)    # debug
-    else: ts_out = dateutil.parser.parse(ts_out)
+    if cache is not None:
+        return cache.buckets(ts_in, ts_out)
+    t_in, t_out = epoch(ts_in), epoch(ts_out)
+    return [(since, min(since + pagerduty.chunk, t_out)) for since in xrange(t_in, max(t_out, t_in + 1), pagerduty.chunk)]
 
-    if args.debug:
-        print "2-type(ts_in):  ", ; print type(ts_in)   # debug
-        print "2-type(ts_out): ", ; print type(ts_out)  # debug
+################################################################################
+def fetch_pd_chunk(schedId, ts_in, ts_out, debug=False, fatal=True):
+    """ Fetch the entries of the ts_in/ts_out range, one page of 'page_size' entries at a time (following the
+        offset/more pagination), sorted by start time. Return None if a page could not be fetched and not 'fatal' """
+
+    entries = []
+    while True:
+        content = query_pd_schedule(schedId, ts_in, ts_out, debug, fatal, offset=len(entries))
+        if content is None:
+            return None
+        page = content.get('entries') or []
+        entries.extend(page)
+        more = content.get('more')
+        if more is None:    ### API v1 has no 'more' flag, only the 'total' ...
+            more = len(entries) < int(content.get('total') or 0)
+        if not more or not page:
+            break
+    starts = parse_epochs(e.get('start') for e in entries)
+    return [entries[i] for i in sorted(xrange(len(entries)), key=starts.__getitem__)]
+
+################################################################################
+def iter_pd_entries(schedId, ts_in, ts_out, debug=False, fresh=False):
+    """ Yield the PagerDuty schedule entries between the ts_in/ts_out datetimes, sorted by start time and without
+        duplicates. The range is fetched by chunks, 'fetch_workers' chunks at a time and concurrently, so only those
+        chunks are ever held in memory. With the cache, only the stale or invalidated buckets are fetched from
+        PagerDuty, and the cache answers alone when PagerDuty is unreachable. A 'fresh' (short) range is fetched
+        exactly, whatever the cache age, and merged into the cache """
+
+    fallback = cache is not None and cache.covers(schedId, ts_in, ts_out)
+    if fresh and cache is not None:
+        entries = fetch_pd_chunk(schedId, ts_in, ts_out, debug, fatal=not fallback)
+        if entries is None:
+            alogger.warning( "Warning - PagerDuty unreachable, using the cached schedule for %s -> %s" % (ts_in, ts_out) )
+            entries = cache.entries(schedId, ts_in, ts_out)
+        else:
+            cache.merge(schedId, ts_in, ts_out, entries)
+        for entry in entries:
+            yield entry
+        return
+
+    stale    = cache is not None and set(cache.stale(schedId, ts_in, ts_out))
+    chunks   = pd_chunks(ts_in, ts_out)
+    spanning = set()    ### Entries already yielded which may show up again in the next chunk ...
+
+    def fetch_chunk(chunk):
+        return fetch_pd_chunk(schedId, datetime.datetime.fromtimestamp(chunk[0], tzutc()),
+                              datetime.datetime.fromtimestamp(chunk[1], tzutc()), debug, fatal=not fallback)
+
+    for w in xrange(0, len(chunks), pagerduty.workers):
+        window  = chunks[w:w + pagerduty.workers]
+        fetch   = [chunk for chunk in window if cache is None or chunk in stale]
+        fetched = {}
+        if args.debug and fetch:
+            clogger.debug( "Fetching %s schedule chunk(s): %s" % (len(fetch), ", ".join("%s -> %s" % (
+                datetime.datetime.fromtimestamp(since, tzutc()), datetime.datetime.fromtimestamp(until, tzutc())) for since, until in fetch)) )
+
+        for chunk, entries, error in run_parallel(fetch_chunk, fetch, pagerduty.workers):
+            if error is not None:
+                raise error
+            if entries is None:
+                alogger.warning( "Warning - PagerDuty unreachable, using the cached schedule for %s -> %s" % (
+                                 datetime.datetime.fromtimestamp(chunk[0], tzutc()), datetime.datetime.fromtimestamp(chunk[1], tzutc())) )
+                continue
+            if cache is not None:
+                cache.store(schedId, chunk[0], chunk[1], entries)
+            else:
+                fetched[chunk] = entries
+
+        for since, until in window:
+            if cache is not None:
+                entries = cache.entries(schedId, max(ts_in,  datetime.datetime.fromtimestamp(since, tzutc())),
+                                                 min(ts_out, datetime.datetime.fromtimestamp(until, tzutc())))
+            else:
+                entries = fetched.pop((since, until), [])
+            carried, spanning = spanning, set()
+            starts = parse_epochs(entry.get('start') for entry in entries)
+            ends   = parse_epochs(entry.get('end')   for entry in entries)
+            for entry, start, end in zip(entries, starts, ends):
+                key = (int(start), entry.get('user').get('id'))
+                if end > until:
+                    spanning.add(key)
+                if key not in carried:
+                    yield entry
+
+################################################################################
+class Deadline(object):
+    """ Time budget of a run. Each phase gets a share of the overall deadline, and low-priority work is
+        deferred to the next run once the budget is spent. 'seconds' = None means no deadline (daemon mode) """
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds and float(seconds) or None
+        self.expires = seconds and time.time() + float(seconds) or None
+
+    def remaining(self):
+        """ Seconds left before the deadline """
+        if self.expires is None:
+            return float('inf')
+        return max(0.0, self.expires - time.time())
+
+    def budget(self, share, reserve=0):
+        """ Seconds allowed to a phase taking 'share' of the overall deadline, keeping 'reserve' seconds for later phases """
+        if self.expires is None:
+            return float('inf')
+        return max(0.0, min(self.remaining() - reserve, self.seconds * share))
+
+    def allows(self, seconds):
+        """ True if 'seconds' of work still fit in the budget """
+        return self.remaining() >= seconds
+
+################################################################################
+def acquire_lock(path):
+    """ Hold an exclusive lock on 'path' for the life of the process. Exit right away if another instance has it """
+
+    global lock_file
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        alogger.warning( "Warning - Another instance of Phone_Agent is running (lock: %s). Exiting." % path )
+        sys.exit(0)
+
+################################################################################
+class Lease(object):
+    """ Base of the lease backends: a named lease is held by one holder at a time, until it expires or is released.
+        A backend only implements update(name, change): atomically apply change() to the (holder, expires, epoch)
+        record of the lease, across all the hosts sharing it """
+
+    def update(self, name, change):
+        """ Replace the lease record by change(record), unless it returns None. Return the record now in place """
+        raise NotImplementedError
+
+    def acquire(self, name, holder, ttl):
+        """ Take or renew the lease for 'holder' for 'ttl' seconds, unless another holder has it and it has not expired.
+            Return the lease epoch (bumped at each change of holder, a fencing token), None if not granted """
+        now = time.time()
+
+        def change(record):
+            current, expires, epoch = record
+            if current not in (None, holder) and expires > now:
+                return None
+            return (holder, now + ttl, current == holder and epoch or epoch + 1)
+
+        record = self.update(name, change)
+        return record[0] == holder and record[2] or None
+
+    def release(self, name, holder):
+        """ Give the lease up, if 'holder' has it """
+        self.update(name, lambda record: record[0] == holder and (None, 0, record[2]) or None)
+
+    def holder(self, name):
+        """ (holder, expires epoch, epoch) of the lease """
+        return self.update(name, lambda record: None)
+
+class LocalLease(Lease):
+    """ In-process lease: the local stand-in of the shared backends (single host, simulations) """
+
+    def __init__(self, path=None):
+        self.lock   = threading.Lock()
+        self.leases = {}
+
+    def update(self, name, change):
+        with self.lock:
+            record = self.leases.get(name, (None, 0, 0))
+            record = change(record) or record
+            self.leases[name] = record
+            return record
+
+class SQLiteLease(Lease):
+    """ Lease kept in a SQLite file shared by the hosts (e.g. on a shared volume) """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db   = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)  ### Explicit transactions ...
+        self.db.execute("CREATE TABLE IF NOT EXISTS ha_lease (name TEXT PRIMARY KEY, holder TEXT, expires REAL, epoch INTEGER)")
+
+    def update(self, name, change):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                record = self.db.execute("SELECT holder, expires, epoch FROM ha_lease WHERE name=?", (name,)).fetchone() or (None, 0, 0)
+                new    = change(tuple(record))
+                if new is not None:
+                    self.db.execute("INSERT OR REPLACE INTO ha_lease VALUES (?, ?, ?, ?)", (name,) + tuple(new))
+                    record = new
+            finally:
+                self.db.execute("COMMIT")
+        return tuple(record)
+
+class DirectoryLease(Lease):
+    """ Lease kept as a JSON file in a directory shared by the hosts, updated under an flock of its .lock file and
+        replaced atomically """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def update(self, name, change):
+        path = os.path.join(self.path, "%s.lease" % name)
+        with self.lock:
+            with open(path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    record = (None, 0, 0)
+                    if os.path.exists(path):
+                        with open(path) as f:
+                            content = json.load(f)
+                        record = (content.get('holder'), content.get('expires', 0), content.get('epoch', 0))
+                    new = change(record)
+                    if new is not None:
+                        with open(path + '.tmp', 'w') as f:
+                            json.dump(dict(zip(('holder', 'expires', 'epoch'), new)), f)
+                        os.rename(path + '.tmp', path)
+                        record = new
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        return record
+
+LEASE_BACKENDS = {'local': LocalLease, 'sqlite': SQLiteLease, 'directory': DirectoryLease}
+
+################################################################################
+def lease_backend(kind, path):
+    """ The lease backend 'kind': one of LEASE_BACKENDS, or the dotted name of a Lease class (custom backend) """
+
+    if kind in LEASE_BACKENDS:
+        return LEASE_BACKENDS[kind](path)
+    module, _, name = kind.rpartition('.')
+    return getattr(importlib.import_module(module), name)(path)
+
+################################################################################
+class LeaderElection(object):
+    """ Leader election between the agents of several hosts over a shared lease: the lease holder is the leader, and
+        renews it every 'heartbeat' seconds for 'ttl' seconds. It only counts itself as the leader until 'heartbeat'
+        seconds before its lease expires (clock skew margin). A standby tries to take the lease at the same pace, so it
+        takes over within 'ttl' + 'heartbeat' seconds of the last heartbeat of a dead leader """
+
+    def __init__(self, backend, name, holder, ttl=15, heartbeat=5):
+        self.backend   = backend
+        self.name      = name
+        self.holder    = holder
+        self.ttl       = float(ttl)
+        self.heartbeat = float(heartbeat)
+        self.epoch     = None   ### Lease epoch while leading ...
+        self.until     = 0      ### ... and end of the leadership, unless renewed
+        self.role      = None   ### Last role logged: True (leader), False (standby) ...
+        self.callbacks = []     ### callback(leading) on every change of role ...
+        self.stopping  = threading.Event()
+        self.thread    = None
+
+    def leading(self):
+        """ True while this agent holds the lease """
+        return time.time() < self.until
+
+    def beat(self):
+        """ One heartbeat: take or renew the lease. Return True while leading """
+        started = time.time()
+        try:
+            epoch = self.backend.acquire(self.name, self.holder, self.ttl)
+        except Exception, e:    ### Keep the leadership until the lease would expire: the backend may be back by then ...
+            alogger.warning( "Warning - HA lease backend error: %s %s" % (Exception, e) )
+        else:
+            self.epoch = epoch
+            self.until = epoch is not None and started + self.ttl - self.heartbeat or 0
+
+        leading = self.leading()
+        if leading != self.role:
+            self.role = leading
+            if leading:
+                alogger.info( "HA: %s is now the leader (lease %s, epoch %s)" % (self.holder, self.name, self.epoch) )
+            else:
+                try:
+                    holder, expires, epoch = self.backend.holder(self.name)
+                except Exception, e:    ### Backend down: a standby all the same, the next beats retry ...
+                    alogger.warning( "HA: %s is a standby (lease %s unreadable: %s %s)" % (self.holder, self.name, Exception, e) )
+                else:
+                    alogger.warning( "HA: %s is a standby (lease %s held by %s until %s)" % (self.holder, self.name, holder,
+                                     time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(expires))) )
+            metrics.set('phone_agent_leader', int(leading))
+            for callback in self.callbacks:
+                callback(leading)
+        return leading
+
+    def fenced(self):
+        """ True while leading and the lease still names this agent with its epoch: checked against the backend before
+            a switchover writes, so an agent which lost the lease unnoticed (paused, clock drift) does not write """
+        if not self.leading():
+            return False
+        try:
+            holder, expires, epoch = self.backend.holder(self.name)
+        except Exception, e:    ### Backend down: the leadership holds until the lease would expire (see beat) ...
+            alogger.warning( "Warning - HA lease backend error, fencing on the local lease: %s %s" % (Exception, e) )
+            return True
+        return holder == self.holder and epoch == self.epoch
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.beat()
+            except Exception, e:    ### The heartbeat must outlive any error, or the agent never leads again ...
+                alogger.error( "Error - HA heartbeat failed: %s %s" % (Exception, e) )
+            self.stopping.wait(self.heartbeat)
+
+    def start(self):
+        """ Heartbeat in the background """
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the heartbeat and give the lease up, so that a standby takes over right away """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(self.heartbeat)
+        if self.epoch is not None:
+            self.until = 0
+            try:
+                self.backend.release(self.name, self.holder)
+            except Exception, e:
+                alogger.warning( "Warning - Unable to release the HA lease: %s %s" % (Exception, e) )
+
+################################################################################
+def leading():
+    """ True if this agent may switch Phone_Ctlr over: always without HA, only while holding the lease with it """
+
+    return leader is None or leader.leading()
+
+################################################################################
+def fenced():
+    """ leading(), with the lease epoch checked against the backend: done before the journal and Phone_Ctlr writes """
+
+    return leader is None or leader.fenced()
+
+################################################################################
+class PagerDutyClient(object):
+    """ PagerDuty REST API client: a keep-alive connection pool, connect/read timeouts and a retry budget of
+        'attempts' tries with a jittered exponential backoff (honoring Retry-After on 429 responses) """
+
+    def __init__(self, base_url, auth, connect_timeout=5, read_timeout=20, attempts=5, backoff=1, max_backoff=30, pool_size=10,
+                 page_size=100, chunk_hours=24, fetch_workers=4):
+        self.base_url    = base_url.rstrip('/')
+        self.timeout     = (float(connect_timeout), float(read_timeout))
+        self.attempts    = int(attempts)
+        self.backoff     = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.page_size   = int(page_size)           ### Entries per page of a schedule fetch ...
+        self.chunk       = int(chunk_hours) * 3600  ### Long ranges are fetched by chunks (the cache buckets if enabled) ...
+        self.workers     = max(1, min(int(fetch_workers), int(pool_size)))
+        self.session     = Lazy(lambda: self.connect(auth, int(pool_size)), "PagerDuty session")  ### Not needed when the cache answers ...
+
+    def connect(self, auth, pool_size):
+        """ The keep-alive session to PagerDuty """
+        session      = requests.Session()
+        session.auth = auth
+        adapter      = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://',  adapter)
+        return session
+
+    def delay(self, attempt, response=None):
+        """ Seconds to wait before the next attempt: Retry-After if PagerDuty asked for it, a full-jitter exponential backoff otherwise """
+        if response is not None and response.headers.get('Retry-After'):
+            try:
+                return min(float(response.headers.get('Retry-After')), self.max_backoff)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def get(self, url, budget=None, **kwargs):
+        """ GET 'url' (relative to the API base url if it starts with '/'). Retry on connection errors, 429 and 5xx
+            responses; raise the last error once the retry budget, or the 'budget' seconds of time, are exhausted """
+        if url.startswith('/'):
+            url = self.base_url + url
+        give_up = time.time() + (budget if budget is not None else float('inf'))
+
+        for attempt in xrange(1, self.attempts + 1):
+            response = None
+            try:
+                if args.debug:
+                    clogger.debug( "Trying PagerDuty url. Attempt no: %s" % attempt )
+                timeout  = (self.timeout[0], max(1.0, min(self.timeout[1], give_up - time.time())))
+                response = self.session.get(url, timeout=timeout, **kwargs)
+                metrics.inc('phone_agent_pagerduty_requests_total', status=response.status_code)
+                if response.status_code != 429 and response.status_code < 500:
+                    return response
+                error = requests.HTTPError("HTTP %s" % response.status_code)
+            except requests.RequestException, e:
+                metrics.inc('phone_agent_pagerduty_requests_total', status='error')
+                error = e
+
+            alogger.warning( "Warning - PagerDuty API connection problem (attempt: %s of %s): %s %s" % (attempt, self.attempts, Exception, error) )
+            if attempt < self.attempts:
+                delay = self.delay(attempt, response)
+                if time.time() + delay + self.timeout[0] >= give_up:
+                    alogger.warning( "Warning - Out of time for PagerDuty retries after %s attempts" % attempt )
+                    break
+                metrics.inc('phone_agent_pagerduty_retries_total')
+                sleep(delay, 'pagerduty_backoff')
+
+        raise error
+
+################################################################################
+@timed('pd_fetch')
+def query_pd_schedule(schedId, ts_in, ts_out, debug=False, fatal=True, offset=0):
+    """ Query one page of the PagerDuty schedule entries between the ts_in/ts_out datetimes and return the decoded
+        response. Exit on PagerDuty errors, or return None when not 'fatal' (the caller has a fallback) """
 
     ############################################################################
     ### Build the PagerDuty API URL with specific schedule start/stop datetime (include whole shift) ...
     ############################################################################
-    url = "https://my_company.pagerduty.com/api/v1/schedules/%s/entries?since=%s&until=%s&overflow=true" % (
+    url = "%s/schedules/%s/entries?since=%s&until=%s&overflow=true&offset=%s&limit=%s" % (
+                                                pagerduty.base_url,
                                                 schedId,
                                                 ts_in.strftime('%Y-%m-%dT%H:%M:%S%z'),
-                                                ts_out.strftime('%Y-%m-%dT%H:%M:%S%z'))
+                                                ts_out.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                                                offset,
+                                                pagerduty.page_size)
     if args.debug:
-        print "URL: %s" % url   # debug
+        clogger.debug( "URL: %s" % url )
 
     ############################################################################
-    ### Query the pager Duty service (upto 5 times if necessary) ...
+    ### Query the pager Duty service (retrying with backoff if necessary) ...
     ############################################################################
-    for x in xrange(1,5):
-        try:
-            if args.debug:
-                print "Trying PagerDuty url. Attempt no: %s" % x   # debug
-            r = requests.get(url, auth=('pagerdutyapiuser@my_company.com', 'my_company12345678'))  # my_company12345678 => PD-Token
-            break
-        except Exception, e:
-            alogger.warning( "Warning - PagerDuty API connection problem (attempt: %s of 5): %s %s" % (x, Exception, e) )
-            try:
-                send_email(ses, email, e)
-            except Exception1, ex1:
-                print "Failed to send mail to %s: %s %s" % (email, Exception1, ex1)
-    else: ### Bail out if too stubborn ...
-        alogger.error( "Error - Cannot recover from PagerDuty API connection problem (after trying %s/5): %s %s" % (x, Exception, e) )
+    try:
+        r = pagerduty.get(url, budget=deadline.budget(0.25))    ### Schedule fetch: a quarter of the run at most ...
+    except Exception, e:  ### Bail out if too stubborn: one alert for the whole retry budget ...
+        alogger.error( "Error - Cannot recover from PagerDuty API connection problem (after trying %s/%s): %s %s" % (pagerduty.attempts, pagerduty.attempts, Exception, e) )
+        alert('pagerduty_unreachable',
+                   "<dl><dt><b>Error:</b></dt><dd>Couldn't connect to PagerDuty after %s attempts: %s.</dd>\
+                   <dt><b>Result:</b></dt><dd>Phone_Ctlr was NOT switched over%s.</dd>\
+                   <dt><b>Troubleshooting:</b></dt><dd>Review connectivity to PagerDuty URL:<br />%s</dd></dl>" % (pagerduty.attempts, e, "" if fatal else " (unless the cached schedule was enough)", url),
+                   schedId
+        )
+        if not fatal:
+            return None
         sys.exit(1)
 
     content = json.loads(r.content)
 
     if args.debug:
-        print json.dumps(content, sort_keys=True, separators=(', ', ': '), indent=4)  # debug
+        clogger.debug( json.dumps(content, sort_keys=True, separators=(', ', ': '), indent=4) )
         #print json.dumps(json.load(f1), sort_keys=True, separators=(', ', ': '), indent=4)  # debug
         #-OR-
         #s = json.dumps(json.loads(r.content), sort_keys=True, separators=(', ', ' : '), indent=4)
         #print '\n'.join([l.rstrip() for l in  s.splitlines()])
 
     if content.has_key("error"):
-        send_email(ses, email,
+        alert('pagerduty_error',
                    "<dl><dt><b>Error:</b></dt><dd>Couldn't connect to PagerDuty: %s.</dd>\
                    <dt><b>Result:</b></dt><dd>Phone_Ctlr was NOT switched over.</dd>\
-                   <dt><b>Troubleshooting:</b></dt><dd>Review connectivity to PagerDuty URL:<br />%s</dd></dl>" % (str(content.get("error").get("message")), url)
+                   <dt><b>Troubleshooting:</b></dt><dd>Review connectivity to PagerDuty URL:<br />%s</dd></dl>" % (str(content.get("error").get("message")), url),
+                   schedId
         )
 
        #send_email(ses, email,
@@ -274,139 +1551,743 @@ def get_pd_schedule(schedId, ts_in=None, ts_out=None, debug=False):  # ts_... =>
        #           "Troubleshooting: Review connectivity to PagerDuty URL:<br />%s" % url
        #)
 
+        if not fatal:
+            return None
         sys.exit(2)
 
+    return content
+
+################################################################################
+@timed('pd_schedule')
+def get_pd_schedule(schedId, ts_in=None, ts_out=None, debug=False):  # ts_... => Timestamps ...
+    """ Extract the PagerDuty schedule for the specified PD_group for the datetime_range specified by ts_in/ts_out """
+
+    sch_beg = sch_end = 0
+
+    if args.debug:
+        clogger.debug( "Entering function with: ts_in: %s, ts_out: %s" % (ts_in, ts_out) )
+        clogger.debug( "1-type(ts_in):  %s" % type(ts_in) )
+        clogger.debug( "1-type(ts_out): %s" % type(ts_out) )
+
     ############################################################################
-    ### If 'total entries' >1: this means it is time to switch Phone_Ctlr ...
+    # Use current time if timestamp range not specified ...
     ############################################################################
-    if content.get('total') > 1:
-        if args.debug:
-            print "Time to change Phone_Ctlr setup"
-    else:
-        if args.debug:
-            print "Wait to change Phone_Ctlr setup"
+    now1 = clock.now(tzlocal()).replace(microsecond=0)
+    if args.debug:
+        clogger.debug( "Now1: %s" % now1 )
+       #print "Now1: %s" % now1.strftime("%Y-%m-%dT%H:%M:%S%z")   # debug
+
+    ### ts_in is null or == '0' or == 'now' ...
+    if not ts_in  or ts_in.lower()  == 'now' or ts_in  == '0':
+        ts_in  = now1
+        if args.debug: clogger.debug( "2-Timestamps=='now' or 0 or null, using current time: ts_in:  %s" % (ts_in) )
+    else: ts_in = parse_iso(ts_in)
+
+    ### ts_out is null or == '0' or 'now' ...
+    if not ts_out or ts_out.lower() == 'now' or ts_out == '0':
+        ts_out = now1
+        if args.debug: clogger.debug( "2-Timestamps=='now' or 0 or null, using current time: ts_out: %s" % (ts_out) )
+    else: ts_out = parse_iso(ts_out)
+
+    if args.debug:
+        clogger.debug( "2-type(ts_in):  %s" % type(ts_in) )
+        clogger.debug( "2-type(ts_out): %s" % type(ts_out) )
 
     who1 = who2 = None
+    id1  = id2  = None
     cnt=0
 
-    for entry in content.get('entries'): # From URL
+    ### The switchover window itself is always fetched (and merged into the cache): a last-minute override must not wait
+    ### for the cache 'ttl'. For that window, the cache is only the fallback when PagerDuty is unreachable ...
+    for entry in iter_pd_entries(schedId, ts_in, ts_out, debug, fresh=True): # From URL (or the schedule cache), streamed
         if args.debug:
-            print "\nEntry " + str(cnt) # debug
-            print "Name: %-20s (Id: %8s) -- Start: %s -> End: %s" % (entry.get('user').get('name'),   # debug
-                                                                     entry.get('user').get('id'),     # debug
-                                                                     entry.get('start'),              # debug
-                                                                     entry.get('end'))                # debug
-        if cnt == 0: who1 = entry.get('user').get('name')
-        who2 = who1
-        if cnt == 1: who2 = entry.get('user').get('name')
+            clogger.debug( "Entry " + str(cnt) )
+            clogger.debug( "Name: %-20s (Id: %8s) -- Start: %s -> End: %s" % (entry.get('user').get('name'),
+                                                                             entry.get('user').get('id'),
+                                                                             entry.get('start'),
+                                                                             entry.get('end')) )
+        if cnt == 0: who1, id1 = entry.get('user').get('name'), entry.get('user').get('id')
+        who2, id2 = who1, id1
+        if cnt == 1: who2, id2 = entry.get('user').get('name'), entry.get('user').get('id')
         cnt += 1
 
-    sch_beg = str(dateutil.parser.parse(entry.get('start')))
-    sch_end = str(dateutil.parser.parse(entry.get('end')))
-
-    return (who1, who2, sch_beg, sch_end)
-
-#################
-##    MAIN
-#################
+    ############################################################################
+    ### If 'total entries' >1: this means it is time to switch Phone_Ctlr ...
+    ############################################################################
+    if cnt > 1:
+        if args.debug:
+            clogger.debug( "Time to change Phone_Ctlr setup" )
+    else:
+        if args.debug:
+            clogger.debug( "Wait to change Phone_Ctlr setup" )
 
-if __name__ == '__main__':
+    sch_beg = str(parse_iso(entry.get('start')))
+    sch_end = str(parse_iso(entry.get('end')))
 
-    VERSION='0.1'
+    return (who1, who2, sch_beg, sch_end, id1, id2)
 
-    parser = argparse.ArgumentParser(description = "Phone Line Redirector for Phone_Ctlr", add_help=True, version=VERSION)
-    parser.add_argument('conf_file',       action='store',      default="Phone_Agent.conf",    help = "Phone extension conf file")
-    parser.add_argument('start_datetime',  action='store',                     help = "Begining of coverage")
-    parser.add_argument('end_datetime',    action='store',                     help = "End of coverage")
-    parser.add_argument('--verbose',       action='store_true', default=False, help = "Show verbose output")
-    parser.add_argument('-l', '--lookahead',  action='store',      default=int(8),help = "Lookahead before and after current time")
-    parser.add_argument('-d', '--debug',   action='store_true', default=False, help = "Show debug info")
-    parser.add_argument('-t', '--test',    action='store_true', default=False, help = "Test mode - Does not call out")
-   #parser.add_argument('-V', '--version', action='version',   version='%(prog)s: 1.0')
-    args = parser.parse_args()
+################################################################################
+Shift = collections.namedtuple('Shift', 'start end user_id name')
+
+def entry_shift(entry):
+    """ The Shift of a PagerDuty schedule entry """
+    return Shift(parse_iso(entry.get('start')), parse_iso(entry.get('end')),
+                 entry.get('user').get('id'), entry.get('user').get('name'))
+
+def iter_handoffs(shifts, ts_in):
+    """ Yield every change of on-call person from a stream of shifts sorted by start time, from ts_in on:
+        (boundary, Shift leaving, Shift entering). Only the previous shift is held in memory """
+    t_in     = isinstance(ts_in, datetime.datetime) and epoch(ts_in) or ts_in
+    previous = None
+    for shift in shifts:
+        if previous is not None and shift.user_id != previous.user_id and epoch(shift.start) >= t_in:
+            yield (shift.start, previous, shift)
+        previous = shift
+
+class ShiftIndex(object):
+    """ Sorted interval index of on-call shifts built from PagerDuty schedule entries.
+
+        The final schedule has no overlapping shifts, so a bisection over the shift starts answers "who is on call
+        at T" and range queries in O(log n). Usable from Python without any API call once built:
+
+            index = ShiftIndex(entries)         # entries: [{'start':..., 'end':..., 'user': {'id':..., 'name':...}}, ...]
+            index.at(ts)                        # -> Shift(start, end, user_id, name) or None
+            index.between(ts_in, ts_out)        # -> [Shift, ...]
+            index.handoffs(ts_in, ts_out)       # -> [(boundary, Shift leaving, Shift entering), ...]
+    """
+
+    def __init__(self, entries=()):
+        entries = list(entries)
+        shifts  = {}
+        for entry, start, end in zip(entries, parse_epochs(e.get('start') for e in entries), parse_epochs(e.get('end') for e in entries)):
+            shifts[(int(start), entry.get('user').get('id'))] = (int(end), entry)  ### Same shift seen twice (overlapping fetches) ...
+        keys        = sorted(shifts)
+        self.shifts = [entry_shift(shifts[k][1]) for k in keys]
+        self.starts = [k[0] for k in keys]
+        self.ends   = [shifts[k][0] for k in keys]
+
+    def __len__(self):
+        return len(self.shifts)
+
+    def at(self, ts):
+        """ The shift on call at 'ts' (datetime or epoch), None if nobody is """
+        t = isinstance(ts, datetime.datetime) and epoch(ts) or ts
+        i = bisect.bisect_right(self.starts, t) - 1
+        if i >= 0 and self.ends[i] > t:
+            return self.shifts[i]
+        return None
+
+    def between(self, ts_in, ts_out):
+        """ The shifts overlapping the ts_in/ts_out range """
+        t_in  = isinstance(ts_in,  datetime.datetime) and epoch(ts_in)  or ts_in
+        t_out = isinstance(ts_out, datetime.datetime) and epoch(ts_out) or ts_out
+        i = max(0, bisect.bisect_right(self.starts, t_in) - 1)
+        j = bisect.bisect_left(self.starts, t_out)
+        return [shift for k, shift in enumerate(self.shifts[i:j], i) if self.ends[k] > t_in]
+
+    def handoffs(self, ts_in, ts_out):
+        """ Every change of on-call person in the ts_in/ts_out range: [(boundary, Shift leaving, Shift entering), ...] """
+        return list(iter_handoffs(self.between(ts_in, ts_out), ts_in))
 
-    email = "opsTeam@saasmail.my_company.com"
+################################################################################
+def get_shift_index(schedId, ts_in, ts_out, debug=False):
+    """ Build the ShiftIndex of a schedule over the ts_in/ts_out datetimes (from the schedule cache when fresh) """
 
-    ############################################################################
-    ### Initialize logging ...
-    ############################################################################
-    setupLogging()
+    return ShiftIndex(iter_pd_entries(schedId, ts_in, ts_out, debug))
 
-    alogger = logging.getLogger("phone_ctlr_log")
-    clogger = logging.getLogger("console_log")
-    alogger.setLevel(logging.INFO)
-    if args.debug:
-        alogger.setLevel(logging.DEBUG)
-        clogger.setLevel(logging.DEBUG)
+################################################################################
+class Team(object):
+    """ A support team: its PagerDuty schedule, its Phone_Ctlr number and its phone directory sections """
+
+    def __init__(self, name, schedule_id, ctlr_number, desk_section='desk_phone', cell_section='cell_phone'):
+        self.name         = name
+        self.schedule_id  = schedule_id
+        self.ctlr_number  = ctlr_number
+        self.desk_section = desk_section
+        self.cell_section = cell_section
+        self.directory    = None    ### PhoneDirectory, see load_directories() ...
+        self.tag          = name and "[%s] " % name or ""   ### Log prefix (empty for the legacy single team) ...
 
-    ############################################################################
-    ### Read the configuration file ...
-    ############################################################################
-    s = ConfigParser.ConfigParser()
-    s.readfp(open(args.conf_file))
-    ses = boto.connect_ses(s.get("awsprod", "access_key"), s.get("awsprod", "secret_key"))  # Establish a boto session ...
+################################################################################
+def load_teams():
+    """ Build the list of teams from the [team:<name>] sections of the config file. Without any, fall back to the
+        single legacy team: [awsprod] pagerduty_schedule_id with the default Phone_Ctlr number and directory """
+
+    teams = []
+    for section in s.sections():
+        if section.startswith('team:'):
+            teams.append(Team(section[len('team:'):].strip(),
+                              s.get(section, 'pagerduty_schedule_id'),
+                              conf_get(section, 'phone_ctlr_number', phone_ctlr_number),
+                              conf_get(section, 'desk_phone', 'desk_phone'),
+                              conf_get(section, 'cell_phone', 'cell_phone')))
+    if teams:
+        return teams
 
     try:
       pagerduty_schedule_id = s.get("awsprod","pagerduty_schedule_id")
     except:
       alogger.error( "Missing pagerduty_schedule_id value in the config file")
-      send_email(ses,
-                 email,
+      alert('config',
                  "<dl><dt><b>Error:</b></dt><dd>Phone_Ctlr might be in an inconsistent state. Missing pagerduty_schedule_id value in the config file.</dd>\
                   <dt><b>Result:</b></dt><dd>Phone_Ctlr might not be set to escalate to the correct person.</dd>\
                   <dt><b>Solution:</b></dt><dd>PLS manually turn on Phone_Ctlr (<a href=\"https://docs.my_company.com/Phone_Ctlr+Cheat+Sheet\">cheat sheet</a>)<br>You can also check the log file <i>%s:/opt/tools/phone_agent/Phone_Agent.log</i></dd></dl>" %
                       (str(socket.gethostname()), )
       )
+      sys.exit(1)
 
-    ############################################################################
-    #-- Twilio REST API version ...
-    ############################################################################
-    apibase = "https://api.twilio.com/"
-    apivers = "2010-04-01"
+    return [Team(None, pagerduty_schedule_id, phone_ctlr_number)]
 
-    ############################################################################
-    ### Read the Twilio credentials ...
-    ############################################################################
-    tw_acct  = s.get('twilio', 'account')
-    tw_token = s.get('twilio', 'token')
+################################################################################
+def run_parallel(func, items, workers, until=None):
+    """ Run func(item) for every item on a bounded pool of 'workers' threads, waiting for them up to the 'until' epoch.
+        Return [(item, result, error), ...] in the order of 'items' (sys.exit() is reported as a SystemExit error,
+        an item still running at 'until' as None) """
+
+    work    = Queue.Queue()
+    results = [None] * len(items)
+    team    = getattr(context, 'team', None)    ### The workers act for the caller's team ...
+    for i, item in enumerate(items):
+        work.put((i, item))
+
+    def worker():
+        context.team = team
+        while True:
+            try:
+                i, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (item, func(item), None)
+            except BaseException, e:
+                if not isinstance(e, SystemExit):
+                    alogger.exception( "Error - %s%s %s" % (getattr(item, 'tag', ''), Exception, e) )
+                results[i] = (item, None, e)
+
+    threads = [threading.Thread(target=worker) for x in xrange(max(1, min(int(workers), len(items))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        while t.is_alive():
+            if until is not None and time.time() >= until:
+                return results
+            t.join(1)   ### Short joins keep the main thread responsive to Ctrl-C ...
+    return results
 
-    ############################################################################
-    #-- Outgoing Caller ID you have previously validated with Twilio ...
-    ############################################################################
-    callerid           = "+18005551212"    # My_Company originating phone number - Twilio verified ...
-    phone_ctlr_number  = "+18005551212"    # Phone_Ctlr phone number to hit to en/disable Phone_Ctlr remotely - Twilio verified ...
+################################################################################
+class SwitchJournal(object):
+    """ Persistent (SQLite) journal of the switchover steps, keyed by (schedule id, handoff, who1, who2) """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db   = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS switch_journal (sched_id TEXT, handoff TEXT, who1 TEXT, who2 TEXT, "
+                        "step TEXT, status TEXT, detail TEXT, updated INTEGER, "
+                        "PRIMARY KEY (sched_id, handoff, who1, who2, step))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS switch_journal_detail ON switch_journal (detail)")
+        self.db.commit()
+
+    def done(self, key, step):
+        """ True if 'step' of the 'key' transition already completed """
+        with self.lock:
+            row = self.db.execute("SELECT status FROM switch_journal WHERE sched_id=? AND handoff=? AND who1=? AND who2=? AND step=?",
+                                  tuple(key) + (step,)).fetchone()
+        return row is not None and row[0] == 'done'
+
+    def record(self, key, step, ok, detail=None):
+        """ Record the outcome of 'step' for the 'key' transition """
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO switch_journal VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            tuple(key) + (step, ok and 'done' or 'failed', detail, int(time.time())))
+            self.db.commit()
+
+    def steps(self, sid):
+        """ The steps done by the call 'sid' (both 'enable' and 'disable' for a batched call) """
+        with self.lock:
+            rows = self.db.execute("SELECT step FROM switch_journal WHERE detail=? AND status='done'", (sid,)).fetchall()
+        return tuple(sorted(row[0] for row in rows))
 
-    ############################################################################
-    ### Let's run everything localized ...
-    ############################################################################
-    os.environ["TZ"] = "PST8PDT"
-    if args.debug: os.system("date +'%nCurrent: %Y-%m-%dT%H:%M:%S%z'") # Display localized system's datetime.
+################################################################################
+def journal_done(key, step):
+    """ True if the switchover journal says 'step' was already done for this transition """
 
-    ############################################################################
-    #-- Instantiate a new Twilio Rest Client ...
-    ############################################################################
-    client = TwilioRestClient(account=tw_acct, token=tw_token, base=apibase, version=apivers)
+    return journal is not None and journal.done(key, step)
 
-    if not args.start_datetime  or args.start_datetime.lower()  == 'now' or args.start_datetime  == '0':
-        now1 = datetime.datetime.now()
-    else:
-        now1 = dateutil.parser.parse(args.start_datetime) # First command line argument ...
+################################################################################
+def journal_record(key, step, result):
+    """ Record the outcome of 'step' in the switchover journal (never in test mode) and pass 'result' through """
+
+    if journal is not None and not args.test:
+        journal.record(key, step, bool(result), result not in (True, False, None) and str(result) or None)
+    return result
+
+################################################################################
+def track_call(sid, what, success=('completed',), kind='person'):
+    """ Follow the Twilio call 'sid' until it ends, polling its status with an exponential backoff.
+        Return the sid if the call ended with one of the 'success' statuses, None otherwise """
+
+    if sid in (None, True, False):  ### No call placed (failure, test mode, ...)
+        return sid
+
+    started  = clock.time()
+    give_up  = started + min(int(conf_get('twilio', 'call_timeout', 120)), deadline.budget(1, ALERT_RESERVE))
+    delay    = 0.5
+    status   = None
+
+    while True:
+        try:
+            status = client.calls.get(sid).status
+        except Exception, e:
+            alogger.warning( "Warning - Unable to get the status of the call to %s (sid: %s): %s %s" % (what, sid, Exception, e) )
+        if status in CALL_FINAL or clock.time() + delay > give_up:
+            break
+        sleep(delay, 'call_status')
+        delay = min(delay * 2, 5)
+
+    if args.debug:
+        clogger.debug( "Call to %s (sid: %s) status: %s" % (what, sid, status) )
+    event('call', what=what, sid=sid, status=status, seconds=round(clock.time() - started, 3), ok=status in success)
+    metrics.inc('phone_agent_calls_total', kind=kind, status=status or 'unknown')
+    if status in success:
+        return sid
+
+    alogger.error( "Call to %s (sid: %s) ended with status: %s" % (what, sid, status) )
+    return None
+
+################################################################################
+def twiml_url(twiml):
+    """ URL of the echo twimlet playing the 'twiml' message """
+
+    url_string = "http://twimlets.com/echo?Twiml=%s" % twiml
+    return urllib.quote_plus(url_string, ':/?=')
+
+def call_person(number, url, name, where):
+    """ Call 'number' and play the message of 'url' (see twiml_url()).
+        Return the call sid once the call ended, None if it failed """
+
+    if args.debug:
+        clogger.debug( "url = %s" % url )
+
+    try:
+        with metrics.timer('phone_agent_twilio_create_seconds', kind='person'):
+            call = client.calls.create(to      = number,
+                                       from_   = callerid,
+                                       timeout = int(10),
+                                       url     = url
+            )
+    except:
+        alogger.error( "Failed  calling %-10s at %s -- Unable to complete the call" % (name, where) )
+        return None
+
+    if track_call(call.sid, "%s at %s" % (name, where), CALL_REACHED) is None:
+        alogger.error( "Failed  calling %-10s at %s -- Call sid: %s" % (name, where, call.sid) )
+        return None
+    alogger.info(  "Success calling %-10s at %s -- Call sid: %s" % (name, where, call.sid) )
+    return call.sid
+
+################################################################################
+@timed('person_calls')
+def place_calls(key, calls):
+    """ Place the [(step, number, url, name, where), ...] calls concurrently and record each of them in the
+        switchover journal. Return True if all of them went through """
+
+    results = run_parallel(lambda c: journal_record(key, c[0], call_person(*c[1:])), calls, max(1, len(calls)))
+    return all(result for call, result, error in results)
+
+################################################################################
+class QuietHours(object):
+    """ The quiet hours policy of [quiet_hours]: the 'passive' windows of local time, when the person entering on-call
+        is neither enabled on Phone_Ctlr nor called, and the 'exiting' ones, when the person leaving is not called.
+
+        The windows (HH:MM-HH:MM, start included and end excluded, comma separated, spanning midnight or not) are
+        precomputed into a table of UTC intervals, local day by local day (DST included) and extended on demand, so
+        that a whole batch of handoffs is classified by a single search through the table:
+
+            quiet = QuietHours('US/Pacific', '22:46-07:00', '07:00-07:15')
+            quiet.classify(epochs)              # -> ['passive', 'active', 'exiting', ...]
+            quiet.at(ts)                        # -> 'passive', 'exiting' or 'active'
+    """
+
+    KINDS = ('passive', 'exiting')     ### The first one wins where windows overlap ...
+
+    def __init__(self, tz='US/Pacific', passive='22:46-07:00', exiting='07:00-07:15'):
+        self.zone = tz
+        self.lock = threading.Lock()
+        minutes   = ['active'] * 1440
+        for kind, spec in reversed(zip(self.KINDS, (passive, exiting))):
+            for start, end in self.windows(spec):
+                for minute in xrange(start, end > start and end or end + 1440):
+                    minutes[minute % 1440] = kind
+        self.day   = [(minute, kind) for minute, kind in enumerate(minutes) if not minute or kind != minutes[minute - 1]]
+        self.table = (None, None, [], [], None)     ### (first day, last day, bounds, kinds, arrays) ...
+
+    @property
+    def tz(self):
+        return timezone(self.zone)  ### pytz only imported once needed ...
+
+    @staticmethod
+    def windows(spec):
+        """ [(start, end), ...] minutes of the day of the 'HH:MM-HH:MM, ...' windows """
+        windows = []
+        for window in (spec or '').split(','):
+            if not window.strip():
+                continue
+            match = re.match(r'^\s*(\d\d?):(\d\d)\s*-\s*(\d\d?):(\d\d)\s*$', window)
+            if match is None or int(match.group(1)) > 24 or int(match.group(3)) > 24 or int(match.group(2)) > 59 or int(match.group(4)) > 59:
+                raise ValueError("[quiet_hours] window %r is not HH:MM-HH:MM" % window.strip())
+            windows.append(((int(match.group(1)) * 60 + int(match.group(2))) % 1440, (int(match.group(3)) * 60 + int(match.group(4))) % 1440))
+        return windows
+
+    def extend(self, t_in, t_out):
+        """ Cover the t_in/t_out epochs with the interval table (whole local days, plus a week ahead) """
+        first = datetime.datetime.fromtimestamp(t_in,  self.tz).date() - datetime.timedelta(days=1)
+        last  = datetime.datetime.fromtimestamp(t_out, self.tz).date() + datetime.timedelta(days=1)
+        with self.lock:
+            if self.table[0] is not None:
+                if self.table[0] <= first and last <= self.table[1]:
+                    return self.table
+                first, last = min(first, self.table[0]), max(last, self.table[1])
+            last  += datetime.timedelta(days=7)
+            bounds = []     ### Epochs where the kind changes ...
+            kinds  = []     ### ... and the kind from there on
+            day    = first
+            while day <= last:
+                midnight = datetime.datetime.combine(day, datetime.time())
+                for minute, kind in self.day:
+                    if not kinds or kind != kinds[-1]:
+                        bounds.append(epoch(self.tz.localize(midnight + datetime.timedelta(minutes=minute))))
+                        kinds.append(kind)
+                day += datetime.timedelta(days=1)
+            self.table = (first, last, bounds, kinds, None)    ### The arrays are built by the first big classify() ...
+        return self.table
+
+    def classify(self, epochs):
+        """ 'passive', 'exiting' or 'active' for each of the epochs, in a single batched search """
+        epochs = list(epochs)
+        if not epochs:
+            return []
+        if vectorized(len(epochs)):
+            epochs = numpy.array(epochs, dtype=numpy.int64)
+            table  = self.extend(int(epochs.min()), int(epochs.max()))
+            arrays = table[4]
+            if arrays is None:
+                arrays = (numpy.array(table[2], dtype=numpy.int64), numpy.array(table[3], dtype=object))
+                with self.lock:
+                    if self.table is table:
+                        self.table = table[:4] + (arrays,)
+            return arrays[1][numpy.searchsorted(arrays[0], epochs, 'right') - 1].tolist()
+        first, last, bounds, kinds, arrays = self.extend(min(epochs), max(epochs))
+        return [kinds[bisect.bisect_right(bounds, t) - 1] for t in epochs]
+
+    def at(self, ts):
+        """ 'passive', 'exiting' or 'active' at 'ts' (datetime or epoch) """
+        return self.classify([isinstance(ts, datetime.datetime) and epoch(ts) or ts])[0]
+
+################################################################################
+def handoff_latency(handoff, stage):
+    """ Observe the time elapsed since the scheduled 'handoff' boundary (negative ahead of it) at 'stage' of the switch """
+
+    metrics.observe('phone_agent_handoff_latency_seconds', clock.time() - iso_epoch(str(handoff)), stage=stage)
+
+################################################################################
+HandoffPlan = collections.namedtuple('HandoffPlan', 'key at quiet ctlr person1 person2 digits calls errors')
+
+def build_plan(team, handoff, who1, who2, id1=None, id2=None, hours=None):
+    """ The validated action plan of a handoff (key: its switchover journal key), from the person leaving on-call duty
+        (who1, PagerDuty user id1) to the person entering it (who2): the normalized Phone_Ctlr and people's numbers,
+        the DTMF tones, the echo twimlet URLs of every call it may place, and the quiet hours at the boundary ('hours'
+        when already classified). Whatever would stop the switchover is listed in 'errors' instead """
+
+    key     = (team.schedule_id, handoff, who1, who2)
+    at      = iso_epoch(str(handoff))
+    hours   = hours or quiet.at(at)
+    errors  = []
+    person1 = team.directory.lookup(id1, who1)     # For person leaving  on-call duty ...
+    person2 = team.directory.lookup(id2, who2)     # For person entering on-call duty ...
+    for person, who, user_id, direction in ((person1, who1, id1, "from"), (person2, who2, id2, "to")):
+        if person is None:
+            errors.append("The config file does not contain phone numbers for: %s (Id: %s), Phone_Ctlr cannot be switched over %s them" % (who, user_id, direction))
+    ctlr = e164(team.ctlr_number)
+    if ctlr is None:
+        errors.append("Invalid Phone_Ctlr number: '%s'" % team.ctlr_number)
+    if errors:
+        return HandoffPlan(key, at, hours, ctlr, person1, person2, {}, {}, errors)
+
+    digits = {'enable':  phone_ctlr_digits('enable',  person2.desk),    # 121w19876#19876#
+              'disable': phone_ctlr_digits('disable', person1.desk),    # 122w12345#12345#
+              'batch':   phone_ctlr_batch_digits([('enable', person2.desk), ('disable', person1.desk)])}
+    for step, tones in sorted(digits.items()):
+        if not re.match(r'^[0-9*#wW]+$', tones):
+            errors.append("Invalid DTMF tones for the Phone_Ctlr %s step: '%s' (check [phone_ctlr] pause)" % (step, tones))
+
+    extended_desk1 = person1.desk_e164 or str(person1.desk)    ### The long extension number when the short one has one ...
+    extended_desk2 = person2.desk_e164 or str(person2.desk)
+    firstname_who1 = (who1 or person1.name).split()[0]         ### Extract first name from complete name
+    firstname_who2 = (who2 or person2.name).split()[0]
+
+    calls = {}
+    ### Call out to the new on-call person through desk phone (using Phone_Ctlr) ...
+    calls['confirm_to']   = ('confirm_to', person2.cell,   # person who is entering on-call ... using the desk phone.
+        twiml_url("<Response><Say>Hello %s, this is the Phone Monkey from My_Company.  The support extension has been enabled for your phone.  You are officially on-call.  Have a good one! Good bye!</Say></Response>" % firstname_who2),
+        firstname_who2, extended_desk2)
+    ### Next: the person leaving on-call (using the cell phone) ...
+    calls['confirm_from'] = ('confirm_from', person1.cell,   # Using the cell phone.
+        twiml_url("<Response><Say voice=\"woman\">Hello %s, this is the Phone Monkey from  My_Company. The support extension switchover was successful.  You are now off-duty.  Take it easy! Good bye!</Say></Response>" % firstname_who1),
+        firstname_who1, person1.cell)
+    ### Phone_Ctlr in an unknown state: both people, on their cell phones since Phone_Ctlr might be broken ...
+    calls['alert_from']   = ('alert_from', person1.cell,   # person who WAS on-call
+        twiml_url("<Response><Say>Hello %s, this is Romeo from My_Company reporting an error. The Phone_Ctlr might be in an inconsistent state. Please contact %s, the new on-call person, to troubleshoot. Thank you.</Say></Response>" % (firstname_who1, firstname_who2)),
+        firstname_who1, person1.cell)
+    calls['alert_to']     = ('alert_to', person2.cell,     # person who IS NOW on-call
+        twiml_url("<Response><Say voice=\"woman\">Hello %s, this is Juliette from My_Company reporting an error. The Phone_Ctlr might be in an inconsistent state. Please contact %s, the previous on-call person, to troubleshoot. Thank you.</Say></Response>" % (firstname_who2, firstname_who1)),
+        firstname_who2, person2.cell)
+
+    return HandoffPlan(key, at, hours, ctlr, person1, person2, digits, calls, errors)
+
+################################################################################
+def plan_alert(team, plans, ahead=True):
+    """ Alert about the handoffs whose plan failed: 'ahead' of time by the planner, or at the handoff itself """
+
+    handoffs = "".join("<li>%s: %s -> %s<br>%s</li>" % (plan.key[1], plan.key[2], plan.key[3], "<br>".join(plan.errors)) for plan in plans)
+    alert(ahead and 'plan' or 'plan_failed',
+               "<dl><dt><b>Error:</b></dt><dd>The switchover of these handoffs cannot be prepared:<ul>%s</ul></dd>\
+                <dt><b>Result:</b></dt><dd>%s</dd>\
+                <dt><b>Solution:</b></dt><dd>PLS fix the phone directory or the Phone_Ctlr settings in the config file: <i>%s</i></dd></dl>" %
+                    (handoffs, ahead and "Phone_Ctlr will NOT be switched over at these handoffs unless fixed before then." or
+                                         "Phone_Ctlr was NOT switched over.", os.path.abspath(args.conf_file)),
+               team.schedule_id
+    )
+
+################################################################################
+class HandoffPlanner(object):
+    """ The plans of the upcoming handoffs, built up to 'hours' ahead of time (see build_plan): at the boundary, the
+        switchover only runs its plan, and a handoff which cannot be planned is alerted about hours before it fails """
+
+    def __init__(self, hours=8):
+        self.hours = int(hours)
+        self.plans = {}     ### Switchover journal key -> HandoffPlan ...
+        self.lock  = threading.Lock()
+
+    def get(self, key):
+        """ The plan of the handoff of journal 'key', None if it was not planned """
+        with self.lock:
+            return self.plans.get(key)
+
+    def plan(self, team, handoffs):
+        """ Plan the team's [(boundary, Shift leaving, Shift entering), ...] handoffs (their quiet hours classified in
+            one batch), alert once about the plans which failed, and return the plans """
+        handoffs = list(handoffs)
+        plans    = [build_plan(team, str(boundary), leaving.name, entering.name, leaving.user_id, entering.user_id, hours)
+                    for (boundary, leaving, entering), hours in zip(handoffs, quiet.classify(epoch(h[0]) for h in handoffs))]
+        with self.lock:
+            for plan in plans:
+                self.plans[plan.key] = plan
+        for plan in plans:
+            metrics.inc('phone_agent_plans_total', status=plan.errors and 'failed' or 'ok')
+        if args.debug:
+            clogger.debug( "%sPlanned %s handoff(s) ahead, %s failed" % (team.tag, len(plans), len([plan for plan in plans if plan.errors])) )
+
+        failed = [plan for plan in plans if plan.errors and not journal_done(plan.key, 'plan_alert')]
+        if failed and leading():    ### Once per handoff, across the runs (and the HA agents) ...
+            for plan in failed:
+                alogger.error( "%sError - The handoff at %s (%s -> %s) cannot be planned: %s" % (team.tag, plan.key[1], plan.key[2], plan.key[3], "; ".join(plan.errors)) )
+                journal_record(plan.key, 'plan_alert', True)
+            plan_alert(team, failed)
+        return plans
+
+    def prune(self, before):
+        """ Forget the plans of the handoffs before the 'before' epoch """
+        with self.lock:
+            for key in [key for key, plan in self.plans.items() if plan.at < before]:
+                del self.plans[key]
+
+################################################################################
+def warm_up():
+    """ Build what a switchover needs on first use ahead of the handoff: the Twilio client (and its imports) and the
+        quiet hours time zone """
+
+    try:
+        client.calls
+        quiet.tz
+    except Exception, e:    ### The switchover will fail on it all the same, and report it ...
+        alogger.warning( "Warning - Warm-up failed: %s %s" % (Exception, e) )
+
+################################################################################
+@timed('switchover')
+def switchover(team, handoff, who1, who2, id1=None, id2=None):
+    """ Move Phone_Ctlr from the person leaving on-call duty (who1, PagerDuty user id1) to the person entering it (who2).
+        Every step is recorded in the switchover journal: a step already done for this handoff is skipped, so
+        overlapping lookahead windows only retry what failed """
+
+    key = (team.schedule_id, handoff, who1, who2)
+    if not fenced():
+        alogger.warning( "%sHA standby: not switching Phone_Ctlr from %s to %s (lease lost)" % (team.tag, who1, who2) )
+        return
+    if journal_done(key, 'switchover'):
+        alogger.info( "%sPhone_Ctlr already switched from %-17s to %-17s (handoff: %s)" % (team.tag, who1, who2, handoff) )
+        return
+
+    alogger.info( "%sSwitching Phone_Ctlr from %-17s to %-17s" % (team.tag, who1, who2) )
+
+    ### Run the plan built ahead of time by the planner (or build it now: numbers, tones, messages, quiet hours) ...
+    plan = planner and planner.get(key)
+    if args.debug:
+        clogger.debug( "%sHandoff plan: %s" % (team.tag, plan and "built ahead of time" or "built now") )
+    plan = plan or build_plan(team, handoff, who1, who2, id1, id2)
+    if plan.errors:
+        for error in plan.errors:
+            alogger.error( "%s%s" % (team.tag, error) )
+        plan_alert(team, [plan], ahead=False)
+        return
+
+    desk1, cell1 = plan.person1.desk, plan.person1.cell
+    desk2, cell2 = plan.person2.desk, plan.person2.cell
+
+    #####################################################
+    ### Initiate the call out using the Twilio client ...
+    #####################################################
+
+    localtime = datetime.datetime.fromtimestamp(plan.at, quiet.tz)   ### Quiet hours as of the handoff boundary ...
+
+    passive_oncall = plan.quiet == 'passive'
+    exiting_passive_oncall = plan.quiet == 'exiting'
+
+    if passive_oncall:
+      alogger.info("Passive on-call: %s" % localtime)
+    elif exiting_passive_oncall:
+      alogger.info("Exiting passive on-call: %s" % localtime)
+    else:
+      alogger.info("Active on-call: %s" % localtime)
+
+
+    settle = float(conf_get('phone_ctlr', 'settle', 2))
+
+    ### Enable and disable in a single call when Phone_Ctlr accepts chained commands ...
+    batched = None
+    if conf_get('phone_ctlr', 'batch', 'false').lower() in ('true', 'yes', 'on', '1') and \
+       not passive_oncall and not journal_done(key, 'enable') and not journal_done(key, 'disable'):
+      batched = phone_controller_batch(tw_acct, tw_token, [('enable', desk2), ('disable', desk1)], args.debug, args.test, plan.ctlr, plan.digits['batch'])
+      if batched:
+          journal_record(key, 'enable',  batched)
+          journal_record(key, 'disable', batched)
+          if not args.test:
+              sleep(settle, 'phone_ctlr_settle')
+      else:
+          alogger.warning( "%sWarning - Batched Phone_Ctlr call failed, falling back to separate calls" % team.tag )
+
+    if batched or passive_oncall or journal_done(key, 'enable'):
+      sid2 = batched or True
+    else:
+      ### Enable first, then disable, making sure someone receive the escalation call if any ...
+      sid2 = journal_record(key, 'enable', phone_controller(tw_acct, tw_token, 'enable',  desk2, args.debug, args.test, plan.ctlr, plan.digits['enable'])) # enable  the new on-call phone ...
+      if sid2 and not args.test:
+          sleep(settle, 'phone_ctlr_settle') ### The call completed: give Phone_Ctlr a moment to finalize the first Phone_Ctlr switch ...
+
+    if not fenced():    ### Lease lost half-way: the new leader finishes from the journal ...
+      alogger.warning( "%sHA standby: lease lost after enabling %s, leaving the rest to the new leader" % (team.tag, who2) )
+      return
+
+    if not sid2:
+      ### Enable failed: keep the person leaving on call rather than leaving nobody enabled, and alert both people ...
+      alogger.error( "%sError - Enabling %s on Phone_Ctlr failed, not disabling %s" % (team.tag, who2, who1) )
+      sid1 = None
+    elif batched or journal_done(key, 'disable'):
+      sid1 = batched or True
+    else:
+      sid1 = journal_record(key, 'disable', phone_controller(tw_acct, tw_token, 'disable', desk1, args.debug, args.test, plan.ctlr, plan.digits['disable'])) # disable the old on-call phone ...
+      if sid1 and not args.test:
+          sleep(settle, 'phone_ctlr_settle') ### The call completed: give Phone_Ctlr a moment to switch between extensions before calling out ...
+
+    if args.debug:
+        clogger.debug( "Extension number:   %s" % desk1 )
+        clogger.debug( "Phone_Ctlr_disable: %s" % plan.digits['disable'] ) # 122w12345#12345#
+        clogger.debug( "Extension number:   %s" % desk2 )
+        clogger.debug( "Phone_Ctlr_enable:  %s" % plan.digits['enable'] )  # 121w19876#19876#
+
+    #####################################################
+    ### Call out to confirm switchover succeeded ...
+    #####################################################
+
+    event('phone_ctlr', handoff=handoff, who1=who1, who2=who2, enable=sid2, disable=sid1, batched=bool(batched), passive=passive_oncall)
+    if sid1 and sid2 and (isinstance(sid1, basestring) or isinstance(sid2, basestring)):   ### Switched by this run ...
+        handoff_latency(handoff, 'phone_ctlr')
+
+    if sid1 and sid2:   ### Both calls to Phone_Ctlr were successful.
+        """ At this point, we have a good feeling that Phone_Ctlr switchover is successful.
+            Now, all is left to do, is to inform both people: 'who1' is leaving, 'who2' is entering on-call.
+        """
+        if args.test:
+            clogger.info( "Would call the desk extension of %-10s (%s) to confirm the switch." % plan.calls['confirm_to'][3:] )
+        else:
+            calls = []  ### Both people are called at the same time ...
+            if passive_oncall:
+              clogger.info( "Skipping the call to the new person (passive on-call)" )
+            elif not journal_done(key, 'confirm_to'):
+              calls.append(plan.calls['confirm_to'])     ### The new on-call person ...
+
+            if exiting_passive_oncall:
+              clogger.info( "Skipping the call to the person leaving (passive on-call)" )
+            elif not journal_done(key, 'confirm_from'):
+              calls.append(plan.calls['confirm_from'])   ### ... and the person leaving on-call
+
+            if calls and not deadline.allows(COURTESY_MIN + ALERT_RESERVE):
+                ### Out of time: leave the confirmation calls to the next run rather than overlapping it ...
+                alogger.warning( "%sWarning - Run budget spent (%.0fs left), deferring the confirmation calls to the next run" % (team.tag, deadline.remaining()) )
+            elif place_calls(key, calls): ### Only a fully confirmed switchover closes the transition; failed calls get retried ...
+                journal_record(key, 'switchover', True)
+                handoff_latency(handoff, 'confirmed')
+
+    else:   ### Something happened: Phone_Ctlr is in an unknown state ...
+    #####################################################
+    ### Call out to the previous on-call person to troubleshoot ...
+    #####################################################
+        if args.test:
+            clogger.info( "Would call the cell phones of %-10s (%s) and %-10s (%s) to inform of the problem." % (plan.calls['alert_from'][3], cell1, plan.calls['alert_to'][3], cell2) )
+        else:
+
+            calls = []
+            if not journal_done(key, 'alert_from'): ### The person who was on-call ...
+                calls.append(plan.calls['alert_from'])
+
+            if not journal_done(key, 'alert_to'):   ### The person entering his on-call duty ...
+                calls.append(plan.calls['alert_to'])
+
+            place_calls(key, calls)
+
+            if not journal_done(key, 'alert_email'):
+                journal_record(key, 'alert_email', alert('phone_ctlr',
+                           "<dl><dt><b>Error:</b></dt><dd>Phone_Ctlr might be in an inconsistent state.</dd>\
+                            <dt><b>Result:</b></dt><dd>Phone_Ctlr might not be set to escalate to the correct person.</dd>\
+                            <dt><b>Solution:</b></dt><dd>PLS manually turn on Phone_Ctlr (<a href=\"https://docs.my_company.com/Phone_Ctlr+Cheat+Sheet\">cheat sheet</a>)<br>You can also check the log file <i>%s:/opt/tools/phone_agent/Phone_Agent.log</i></dd></dl>" %
+                                (str(socket.gethostname()), ),
+                           team.schedule_id
+                ))
+
+################################################################################
+@timed('run')
+def run_once(team, now1):
+    """ Check the team's PagerDuty schedule around 'now1' and switch Phone_Ctlr over if the on-call person changed.
+        Return the switchover journal key of the handoff, None if there was none """
+
+    context.team = team
 
     now1_iso = now1.strftime('%Y-%m-%dT%H:%M:%S%Z') # String representation of current time ...
     if args.debug:
-        print "now1:    %s" % now1_iso
-        print "now1 type: ", ; print type(now1) # debug
-        print "now1_iso type: ", ; print type(now1_iso) # debug
+        clogger.debug( "now1:    %s" % now1_iso )
+        clogger.debug( "now1 type: %s" % type(now1) )
+        clogger.debug( "now1_iso type: %s" % type(now1_iso) )
 
     ############################################################################
     ### Calculate 'args.lookahead' (default=8) minutes before and after current time (default=16-minutes window) ...
     ### This allows the OPS schedule to be changed to almost any time and the script to catch any failed telephone call ...
     ############################################################################
-    nowminus = (now1 + relativedelta(minutes=-int(args.lookahead))).strftime('%Y-%m-%dT%H:%M:%S%z')
-    nowplus  = (now1 + relativedelta(minutes=+int(args.lookahead))).strftime('%Y-%m-%dT%H:%M:%S%z')
+    nowminus = (now1 + datetime.timedelta(minutes=-int(args.lookahead))).strftime('%Y-%m-%dT%H:%M:%S%z')
+    nowplus  = (now1 + datetime.timedelta(minutes=+int(args.lookahead))).strftime('%Y-%m-%dT%H:%M:%S%z')
     if args.debug:
-        print "nowminus:   %s" % nowminus
-        print "nowplus:    %s" % nowplus
+        clogger.debug( "nowminus:   %s" % nowminus )
+        clogger.debug( "nowplus:    %s" % nowplus )
 
     ############################################################################
     ### Query Pager Duty for the current state of affairs ...
@@ -414,159 +2295,1275 @@ if __name__ == '__main__':
     ### who1 = on-call exiting  schedule ...
     ### who2 = on-call entering schedule ...
     ############################################################################
-    who1, who2, begin1, end1 = get_pd_schedule(pagerduty_schedule_id, nowminus, nowplus, args.debug)
+    who1, who2, begin1, end1, id1, id2 = get_pd_schedule(team.schedule_id, nowminus, nowplus, args.debug)
 
     if args.debug:
-        print "\nwho1, who2, begin1, end1: %-30s, %-30s, %s, %s" % (who1, who2, begin1, end1)
+        clogger.debug( "who1, who2, begin1, end1: %-30s, %-30s, %s, %s" % (who1, who2, begin1, end1) )
+
+    event('schedule', begin=begin1, end=end1, who1=who1, who2=who2, id1=id1, id2=id2, handoff=who1 != who2)
 
     if who1 != who2:    # time to swap on-call responsibilities ...
-        alogger.info( "Switching Phone_Ctlr from %-17s to %-17s" % (who1, who2) )
-
-        ### Query the configuration for phone extension ...
-        (desk1, cell1) = get_phone_numbers(who1, "from")    # For person leaving  on-call duty ...
-        (desk2, cell2) = get_phone_numbers(who2, "to")      # For person entering on-call duty ...
-        cell1          = re.sub('^', '+1', re.sub('^1', '', re.sub(r'\D', '', str(cell1))))   ### Cleanup the cell phone from the config file: +1AAANNNXXXX
-        cell2          = re.sub('^', '+1', re.sub('^1', '', re.sub(r'\D', '', str(cell2))))
-        extended_desk1 = re.sub(r'^7', '+1408540', str(desk1))  ### Figure out the long extension number from the potentially short version of it.
-        extended_desk2 = re.sub(r'^7', '+1408540', str(desk2))
-        firstname_who1 = who1.split()[0]    ### Extract first name from complete name
-        firstname_who2 = who2.split()[0]
-
-        #####################################################
-        ### Initiate the call out using the Twilio client ...
-        #####################################################
-        if args.debug: print "\n",
-
-        local_timezone = timezone('US/Pacific')
-        localtime = datetime.datetime.now(local_timezone)
-
-        passive_oncall = False
-        exiting_passive_oncall = False
-
-        if (localtime.hour >= 23 or localtime.hour < 7) or (localtime.hour == 22 and localtime.minute > 45):
-          passive_oncall = True
-          alogger.info("Passive on-call: %s" % localtime)
-        elif (localtime.hour == 7 and localtime.minute < 15):
-          exiting_passive_oncall = True
-          alogger.info("Exiting passive on-call: %s" % localtime)
-        else:
-          alogger.info("Active on-call: %s" % localtime)
+        switchover(team, begin1, who1, who2, id1, id2)
+        return (team.schedule_id, begin1, who1, who2)
+    else:
+       #print "%s - Not time to switch yet. %-17s is still on-call. We will check back 5 minutes from now." % (now1_iso, who1)
+        alogger.info( "%s%-17s is still on-call. We will check back 5 minutes from now." % (team.tag, who1) )
 
+################################################################################
+def run_teams(now1, workers):
+    """ One cron run: every team checked around 'now1', concurrently on up to 'workers' threads. Return the exit code """
+
+    exit_code = 0
+    for i, outcome in enumerate(run_parallel(lambda team: run_once(team, now1), teams, workers, deadline.expires and deadline.expires + ALERT_RESERVE)):
+        if outcome is None:
+            alogger.error( "%sError - Run deadline exceeded (%ss), giving up." % (teams[i].tag, deadline.seconds) )
+            exit_code = max(exit_code, 3)
+            continue
+        team, result, error = outcome
+        if isinstance(error, SystemExit):
+            exit_code = max(exit_code, error.code or 0)
+        elif error is not None:
+            exit_code = max(exit_code, 1)
+    return exit_code
 
-        if passive_oncall:
-          sid2 = True
-        else:
-          ### Enable first, then disable, making sure someone receive the escalation call if any ...
-          sid2 = phone_controller(tw_acct, tw_token, 'enable',  desk2, args.debug, args.test) # enable  the new on-call phone ...
-          time.sleep(5) ### Give Phone_Ctlr the time to finalize the first Phone_Ctlr switch ...
+################################################################################
+def plan_teams(now1, workers):
+    """ Cron runs: plan every team's handoffs of the next [planner] hours beyond this run's lookahead window, so that
+        a handoff which cannot be planned is alerted about hours ahead of time (see HandoffPlanner) """
+
+    now1  = datetime.datetime.fromtimestamp(epoch(now1), tzlocal())
+    since = now1 + datetime.timedelta(minutes=+int(args.lookahead))
+    until = now1 + datetime.timedelta(hours=+planner.hours)
+
+    def plan(team):
+        context.team = team
+        return planner.plan(team, get_shift_index(team.schedule_id, since, until, args.debug).handoffs(since, until))
+
+    for i, outcome in enumerate(run_parallel(plan, teams, workers, deadline.expires)):
+        if outcome is None or outcome[2] is not None:
+            alogger.warning( "%sWarning - Unable to plan the handoffs of the next %s hours: %s" % (teams[i].tag, planner.hours, outcome and outcome[2] or "run deadline exceeded") )
+
+################################################################################
+def watch(schedIds, event=None):
+    """ Event set whenever the webhook receiver notifies a change of one of the schedIds schedules """
+
+    event = event or threading.Event()
+    for schedId in schedIds:
+        wakeups.setdefault(schedId, []).append(event)
+    return event
+
+################################################################################
+def wake_daemons(leading):
+    """ Wake the daemon loops up when this agent becomes the HA leader, to take the pending handoffs over right away """
+
+    if leading:
+        for events in wakeups.values():
+            for waiting in events:
+                waiting.set()
+
+################################################################################
+def run_daemon(team):
+    """ Stay resident: sleep until the team's next handoff boundary (minus the lookahead) and refresh the schedule every
+        'args.refresh' minutes, keeping the config, SES connection and Twilio client warm between handoffs """
+
+    lookahead = datetime.timedelta(minutes=+int(args.lookahead))
+    refresh   = datetime.timedelta(minutes=+int(args.refresh))
+    horizon   = datetime.timedelta(hours=+int(args.horizon))
+    ahead     = datetime.timedelta(hours=+planner.hours)
+    retry     = datetime.timedelta(minutes=+1)
 
+    timeline  = []      ### Upcoming handoffs: [(boundary, who1, who2), ...]
+    done      = set()   ### Handoffs already handled by this process (an override changing who1/who2 is a new handoff) ...
+    attempts  = {}      ### Handoff -> (attempts so far, time of the next one) until it is switched over ...
+    refreshed = None
+    changed   = watch([team.schedule_id])
+    context.team = team
 
-        sid1 = phone_controller(tw_acct, tw_token, 'disable', desk1, args.debug, args.test) # disable the old on-call phone ...
-        time.sleep(25) ### Give Phone_Ctlr the time to switch between extensions before calling the desk phone ...
+    alogger.info( "%sDaemon mode: refreshing the schedule every %s minutes over the next %s hours" % (team.tag, args.refresh, args.horizon) )
 
+    while True:
+        now1 = datetime.datetime.now(tzlocal())
+        wake = None
+
+        try:
+            if refreshed is None or now1 >= refreshed + refresh:
+                until     = now1 + max(horizon, ahead)
+                handoffs  = get_shift_index(team.schedule_id, now1 - lookahead, until, args.debug).handoffs(now1 - lookahead, until)
+                timeline  = [(boundary, leaving.name, entering.name) for boundary, leaving, entering in handoffs if boundary <= now1 + horizon]
+                refreshed = now1
+                if args.debug:
+                    for boundary, who1, who2 in timeline:
+                        clogger.debug( "Handoff at %s: %-20s -> %-20s" % (boundary, who1, who2) )
+
+                ### Plan the handoffs of the next [planner] hours, and get the switchover ready when one is coming ...
+                planner.prune(epoch(now1 - lookahead))
+                if planner.plan(team, [handoff for handoff in handoffs if handoff[0] <= now1 + ahead]):
+                    warm_up()
+
+            for handoff in timeline:
+                if handoff in done or handoff[0] - lookahead > now1:
+                    continue
+                if not leading():               ### HA standby: the leader handles it (and a takeover wakes us up) ...
+                    break
+                tries, after = attempts.get(handoff, (0, None))
+                if tries >= HANDOFF_TRIES or handoff[0] + lookahead < now1:     ### Out of attempts, or out of its lookahead window ...
+                    if tries:
+                        alogger.error( "%sError - Giving up the handoff at %s (%s -> %s) after %s attempt(s)" % (team.tag, handoff[0], handoff[1], handoff[2], tries) )
+                    done.add(handoff)
+                    continue
+                if after is not None and now1 < after:
+                    continue
+                attempts[handoff] = (tries + 1, now1 + retry)
+                key = run_once(team, handoff[0])    ### Center the usual lookahead window on the handoff itself ...
+                if key is None or args.test or journal_done(key, 'switchover'):
+                    done.add(handoff)
+                elif tries + 1 < HANDOFF_TRIES:     ### Failed, or not confirmed yet: the next attempt is a minute away, within the lookahead window ...
+                    alogger.warning( "%sWarning - The handoff at %s is not fully switched over (attempt %s of %s), retrying in a minute" % (team.tag, handoff[0], tries + 1, HANDOFF_TRIES) )
+                else:
+                    alogger.error( "%sError - Giving up the handoff at %s (%s -> %s) after %s attempt(s)" % (team.tag, handoff[0], handoff[1], handoff[2], tries + 1) )
+                    done.add(handoff)
+
+        except SystemExit, e:   ### The PagerDuty/config helpers bail out with sys.exit() -- the daemon must survive them.
+            alogger.error( "%sError - Daemon run aborted (exit code: %s). Retrying in a minute." % (team.tag, e.code) )
+            wake = now1 + retry
+        except Exception, e:
+            alogger.error( "%sError - Daemon run failed: %s %s. Retrying in a minute." % (team.tag, Exception, e) )
+            wake = now1 + retry
+
+        done     = done & set(timeline)     ### Kept until the refreshed timeline drops them ...
+        attempts = dict((h, a) for h, a in attempts.items() if h not in done and h in timeline)
+
+        ########################################################################
+        ### Sleep until the next handoff is within the lookahead window, or until the next schedule refresh ...
+        ########################################################################
+        if wake is None:
+            wake = refreshed + refresh
+            for handoff in timeline:
+                due = max(handoff[0] - lookahead, attempts.get(handoff, (0, handoff[0] - lookahead))[1])
+                if handoff not in done and due < wake and leading():
+                    wake = due
+
+        delay = (wake - datetime.datetime.now(tzlocal())).total_seconds()
         if args.debug:
-            print "\n",
-            print "Extension number:  ", ; print s.get('desk_phone', who1)
-            print "Phone_Ctlr_disable:", ; print "122w%s#%s#" % (desk1, desk1) # 122w12345#12345#
-            print "Extension number:  ", ; print s.get('desk_phone', who2)
-            print "Phone_Ctlr_enable: ", ; print "121w%s#%s#" % (desk2, desk2) # 121w19876#19876#
-
-        #####################################################
-        ### Call out to confirm switchover succeeded ...
-        #####################################################
-
-        if sid1 and sid2:   ### Both calls to Phone_Ctlr were successful.
-            """ At this point, we have a good feeling that Phone_Ctlr switchover is successful.
-                Now, all is left to do, is to inform both people: 'who1' is leaving, 'who2' is entering on-call.
-            """
-            if args.test:
-                print "Would call the desk extension of %-10s (%s) to confirm the switch." % (firstname_who2, extended_desk2)
+            clogger.debug( "Sleeping %.1f seconds, until %s" % (delay, wake) )
+        if delay > 0:
+            changed.wait(delay)
+        if changed.is_set():    ### Schedule change notified by the webhook (or HA takeover): refresh and re-evaluate right away ...
+            changed.clear()
+            refreshed = None
+            alogger.info( "%sSchedule change notified (or HA takeover), re-evaluating the handoffs" % team.tag )
+
+################################################################################
+def parse_timestamp(ts):
+    """ Parse a command line timestamp ('now', '0' or empty meaning the current time) into an aware datetime """
+
+    if not ts or ts.lower() == 'now' or ts == '0':
+        return datetime.datetime.now(tzlocal())
+    ts = parse_iso(ts)
+    return ts.tzinfo is None and ts.replace(tzinfo=tzlocal()) or ts
+
+################################################################################
+def cmd_oncall(options):
+    """ 'oncall' subcommand: resolve who is on call at the --at timestamps, and list the shifts (or --handoffs)
+        of the --since/--until range, for every team (or --team) """
+
+    at    = [parse_timestamp(ts) for ts in options.at]
+    since = options.since and parse_timestamp(options.since)
+    until = options.until and parse_timestamp(options.until)
+    if not at and not since and not until:
+        at = [parse_timestamp('now')]
+    since = since or until or min(at)
+    until = until or since
+    first = min(at + [since])
+    last  = max(at + [until]) + datetime.timedelta(seconds=+1)
+
+    output = []
+    for team in teams:
+        if options.team and team.name != options.team:
+            continue
+        index = get_shift_index(team.schedule_id, first, last, options.debug)
+
+        for ts in at:
+            shift = index.at(ts)
+            output.append({'team': team.name, 'at': ts.isoformat(), 'user_id': shift and shift.user_id, 'name': shift and shift.name,
+                           'start': shift and shift.start.isoformat(), 'end': shift and shift.end.isoformat()})
+        if options.since or options.until:
+            if options.handoffs:
+                handoffs = index.handoffs(since, until)
+                for (boundary, leaving, entering), hours in zip(handoffs, quiet.classify(epoch(h[0]) for h in handoffs)):
+                    output.append({'team': team.name, 'handoff': boundary.isoformat(), 'from': leaving.name, 'from_id': leaving.user_id,
+                                   'to': entering.name, 'to_id': entering.user_id, 'quiet_hours': hours})
             else:
-                if passive_oncall:
-                  print "Skipping the call to the new person (passive on-call)"
-                else:
-                  try: ### Call out to the new on-call person through desk phone (using Phone_Ctlr) ...
-                      url2_string = "http://twimlets.com/echo?Twiml=<Response><Say>Hello %s, this is the Phone Monkey from My_Company.  The support extension has been enabled for your phone.  You are officially on-call.  Have a good one! Good bye!</Say></Response>" % firstname_who2
-                      url2 = quote_plus(url2_string, ':/?=')
-                      if args.debug:
-                          print "url2_string = %s\nurl2 = %s" % (url2_string, url2)
-
-                      call = client.calls.create(to      = cell2,   # person who is entering on-call ... using the desk phone.
-                                                 from_   = callerid,
-                                                 timeout = int(10),
-                                                 url     = url2
-                      )
-                      alogger.info(  "Success calling %-10s at %s -- Call sid: %s" % (firstname_who2, extended_desk2, call.sid) )
-                  except:
-                      alogger.error( "Failed  calling %-10s at %s -- Unable to complete the call" % (firstname_who2, extended_desk2) )
-
-                  time.sleep(20) ### debug
-
-                if exiting_passive_oncall:
-                  print "Skipping the call to the person leaving (passive on-call)"
-                else:
-                  try: ### Next: the person leaving on-call (using the cell phone) ...
-                      url1_string = "http://twimlets.com/echo?Twiml=<Response><Say voice=\"woman\">Hello %s, this is the Phone Monkey from  My_Company. The support extension switchover was successful.  You are now off-duty.  Take it easy! Good bye!</Say></Response>" % firstname_who1
-                      url1 = quote_plus(url1_string, ':/?=')
-                      if args.debug:
-                          print "url1_string = %s\nurl1 = %s" % (url1_string, url1)
-                      call = client.calls.create(to      = cell1,   # Using the cell phone.
-                                                 from_   = callerid,
-                                                 timeout = int(10),
-                                                 url     = url1
-                      )
-                      alogger.info(  "Success calling %-10s at %s -- Call sid: %s" % (firstname_who1, cell1, call.sid) )
-                  except:
-                      alogger.error( "Failed  calling %-10s at %s -- Unable to complete the call" % (firstname_who1, cell1) )
-
-        else:   ### Something happened: Phone_Ctlr is in an unknown state ...
-        #####################################################
-        ### Call out to the previous on-call person to troubleshoot ...
-        #####################################################
-            if args.test:
-                print "Would call the cell phones of %-10s (%s) and %-10s (%s) to inform of the problem." % (firstname_who1, cell1, firstname_who2, cell2)
+                for shift in index.between(since, until):
+                    output.append({'team': team.name, 'user_id': shift.user_id, 'name': shift.name,
+                                   'start': shift.start.isoformat(), 'end': shift.end.isoformat()})
+
+    if options.json:
+        print json.dumps(output, sort_keys=True, indent=2)
+    else:
+        for row in output:
+            prefix = row['team'] and "[%s] " % row['team'] or ""
+            if 'at' in row:
+                print "%s%s  %-20s (Id: %8s) -- Start: %s -> End: %s" % (prefix, row['at'], row['name'], row['user_id'], row['start'], row['end'])
+            elif 'handoff' in row:
+                print "%s%s  %-20s -> %-20s (%s)" % (prefix, row['handoff'], row['from'], row['to'], row['quiet_hours'])
             else:
+                print "%s%-20s (Id: %8s) -- Start: %s -> End: %s" % (prefix, row['name'], row['user_id'], row['start'], row['end'])
+    return 0
 
-                try: ### The person who was on-call ...
-                    url2_string = "http://twimlets.com/echo?Twiml=<Response><Say>Hello %s, this is Romeo from My_Company reporting an error. The Phone_Ctlr might be in an inconsistent state. Please contact %s, the new on-call person, to troubleshoot. Thank you.</Say></Response>" % (firstname_who1, firstname_who2)
-                    url2 = quote_plus(url2_string, ':/?=')
-                    if args.debug:
-                        print "url2_string = %s\nurl2 = %s" % (url2_string, url2)
-                    call = client.calls.create(to     = cell1,   # person who WAS on-call ... using the cell number since Phone_Ctlr might be broken.
-                                               from_  = callerid,
-                                               timeout= int(10),
-                                               url    = url2
-                    )
-                    alogger.info(  "Success calling %-10s at %s -- Call sid: %s" % (firstname_who1, cell1, call.sid) )
-                except:
-                    alogger.error( "Unable to complete the call out to the previous on-call person." )
-
-                time.sleep(25)
-                try: ### The person entering his on-call duty ...
-                    url1_string = "http://twimlets.com/echo?Twiml=<Response><Say voice=\"woman\">Hello %s, this is Juliette from My_Company reporting an error. The Phone_Ctlr might be in an inconsistent state. Please contact %s, the previous on-call person, to troubleshoot. Thank you.</Say></Response>" % (firstname_who2, firstname_who1)
-                    url1 = quote_plus(url1_string, ':/?=')
-                    if args.debug:
-                        print "url1_string = %s\nurl1 = %s" % (url1_string, url1)
-                    call = client.calls.create(to     = cell2,   # person who IS NOW on-call ... using the cell number since Phone_Ctlr might be broken.
-                                               from_  = callerid,
-                                               timeout= int(10),
-                                               url    = url1
-                    )
-                    alogger.info(  "Success calling %-10s at %s -- Call sid: %s" % (firstname_who2, cell2, call.sid) )
-                except:
-                    alogger.error( "Unable to complete the call out to the new on-call person." )
-
-                send_email(ses,
-                           email,
-                           "<dl><dt><b>Error:</b></dt><dd>Phone_Ctlr might be in an inconsistent state.</dd>\
-                            <dt><b>Result:</b></dt><dd>Phone_Ctlr might not be set to escalate to the correct person.</dd>\
-                            <dt><b>Solution:</b></dt><dd>PLS manually turn on Phone_Ctlr (<a href=\"https://docs.my_company.com/Phone_Ctlr+Cheat+Sheet\">cheat sheet</a>)<br>You can also check the log file <i>%s:/opt/tools/phone_agent/Phone_Agent.log</i></dd></dl>" %
-                                (str(socket.gethostname()), )
-                )
+################################################################################
+CallRecord = collections.namedtuple('CallRecord', 'sid start status duration commands')
+
+SWITCH_COMMANDS = ('disable', 'enable')     ### The Phone_Ctlr commands of a switchover, each done once ...
+
+def ctlr_commands(digits):
+    """ The Phone_Ctlr commands ('enable', 'disable') sent by a DTMF tones string, see phone_ctlr_digits() """
 
+    return tuple(sorted({'121': 'enable', '122': 'disable'}[code] for code in re.findall(r'(12[12])w\d+#', digits)))
+
+def call_record(call):
+    """ The CallRecord of a Twilio call resource (naive start times are UTC). Its commands come from the digits sent when
+        the resource has them (the stub calls), else from the switchover journal; None when unknown """
+    start = call.start_time
+    if not isinstance(start, datetime.datetime):
+        start = parse_iso(str(start))
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=tzutc())
+    digits   = getattr(call, 'send_digits', None)
+    commands = digits and ctlr_commands(digits) or (journal is not None and journal.steps(call.sid)) or None
+    return CallRecord(call.sid, start, call.status, int(call.duration or 0), commands)
+
+################################################################################
+def fetch_call_records(number, ts_in, ts_out):
+    """ The Twilio records of the calls to 'number' started in the ts_in/ts_out range, sorted by start time.
+        Twilio filters on whole (UTC) days: the exact range is applied here """
+
+    records = []
+    for call in client.calls.iter(to=number, started_after=ts_in.astimezone(tzutc()).date(),
+                                  started_before=ts_out.astimezone(tzutc()).date()):
+        if not call.start_time:     ### Queued, never started ...
+            continue
+        record = call_record(call)
+        if ts_in <= record.start < ts_out:
+            records.append(record)
+    records.sort(key=lambda r: r.start)
+    return records
+
+################################################################################
+def iter_call_records(number, ts_in, ts_out, batch_days=7, workers=4):
+    """ Yield the Twilio records of the calls to 'number' in the ts_in/ts_out range, sorted by start time. The range is
+        fetched by batches of 'batch_days' days (on UTC midnights), 'workers' batches at a time and concurrently """
+
+    t_in, t_out = epoch(ts_in), epoch(ts_out)
+    step    = int(batch_days) * 86400
+    batches = [(max(b, t_in), min(b + step, t_out)) for b in xrange(t_in - t_in % 86400, t_out, step)]
+
+    def fetch_batch(batch):
+        return fetch_call_records(number, datetime.datetime.fromtimestamp(batch[0], tzutc()),
+                                  datetime.datetime.fromtimestamp(batch[1], tzutc()))
+
+    for w in xrange(0, len(batches), workers):
+        for batch, records, error in run_parallel(fetch_batch, batches[w:w + workers], workers):
+            if error is not None:
+                raise error
+            for record in records:
+                yield record
+
+################################################################################
+def match_handoffs(handoffs, records, before, after):
+    """ Attribute a stream of call records to a stream of (boundary, leaving, entering) handoffs, both sorted by time:
+        a call belongs to the handoff whose [boundary - before, boundary + after] window it started in. Yield
+        (handoff, [records]) for every handoff, and (None, [record]) for each call outside of any window """
+
+    handoffs = iter(handoffs)
+    current  = next(handoffs, None)
+    matched  = []
+    for record in records:
+        while current is not None and record.start > current[0] + after:
+            yield current, matched
+            current, matched = next(handoffs, None), []
+        if current is not None and record.start >= current[0] - before:
+            matched.append(record)
+        else:
+            yield None, [record]
+    if current is not None:
+        yield current, matched
+    for handoff in handoffs:
+        yield handoff, []
+
+################################################################################
+def audit_verdict(handoff, records, late):
+    """ 'ok', 'missed', 'late' or 'duplicated' for a handoff and its Phone_Ctlr call records, and its latency: the seconds
+        from the boundary to the end of the last completed Phone_Ctlr call (negative when switched ahead of it).
+        Only the completed calls count, per command: a failed batch call then separate enable and disable calls is
+        fine. A call of unknown commands may be any command not done by another call """
+
+    done = [record for record in records if record.status == 'completed']
+    if not done:
+        return 'missed', None
+    latency  = (done[-1].start - handoff[0]).total_seconds() + done[-1].duration
+    commands = collections.Counter(command for record in done for command in record.commands or ())
+    unknown  = sum(record.commands is None for record in done)
+    if any(count > 1 for count in commands.values()) or unknown > len(set(SWITCH_COMMANDS) - set(commands)):
+        return 'duplicated', latency
+    if latency > late:
+        return 'late', latency
+    return 'ok', latency
+
+################################################################################
+def percentile(values, q):
+    """ The q-th percentile (0-100) of the sorted 'values' (nearest rank) """
+
+    return values[max(0, int(math.ceil(q / 100.0 * len(values))) - 1)]
+
+################################################################################
+def audit_team(team, handoffs, records, since, until, late, before, after, verbose=False):
+    """ Match the streams of handoffs and Phone_Ctlr call records of a team over the since/until range (see
+        match_handoffs). Return the report rows: the problems (every handoff and the stray calls too if 'verbose'),
+        then the summary """
+
+    rows      = []
+    counts    = collections.Counter()
+    latencies = []
+
+    for handoff, matched in match_handoffs(handoffs, records, before, after):
+        if handoff is None:
+            if not since <= matched[0].start < until:
+                continue
+            counts['stray'] += 1
+            if verbose:
+                rows.append({'team': team.name, 'verdict': 'stray', 'call': matched[0].start.isoformat(),
+                             'sids': [matched[0].sid], 'status': matched[0].status})
+            continue
+        if handoff[0] >= until:
+            continue
+        verdict, latency = audit_verdict(handoff, matched, late)
+        counts[verdict] += 1
+        if latency is not None:
+            latencies.append(latency)
+        if verdict != 'ok' or verbose:
+            rows.append({'team': team.name, 'verdict': verdict, 'handoff': handoff[0].isoformat(), 'from': handoff[1].name,
+                         'to': handoff[2].name, 'latency': latency, 'sids': [record.sid for record in matched]})
+
+    latencies.sort()
+    summary = {'team': team.name, 'summary': True, 'since': since.isoformat(), 'until': until.isoformat(),
+               'handoffs': sum(counts[v] for v in ('ok', 'missed', 'late', 'duplicated'))}
+    summary.update((v, counts[v]) for v in ('ok', 'missed', 'late', 'duplicated', 'stray'))
+    if latencies:
+        summary['latency'] = {'mean': round(sum(latencies) / len(latencies), 1), 'min': latencies[0], 'max': latencies[-1],
+                              'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90), 'p99': percentile(latencies, 99)}
+    rows.append(summary)
+    return rows
+
+################################################################################
+def print_audit(output):
+    """ Print the rows of an audit report as text """
+
+    for row in output:
+        prefix = row['team'] and "[%s] " % row['team'] or ""
+        if row.get('summary'):
+            print "%s%s handoffs: %s ok, %s missed, %s late, %s duplicated (%s stray Phone_Ctlr calls)" % (
+                  prefix, row['handoffs'], row['ok'], row['missed'], row['late'], row['duplicated'], row['stray'])
+            if 'latency' in row:
+                print "%sLatency (s): mean %s, min %s, p50 %s, p90 %s, p99 %s, max %s" % (prefix, row['latency']['mean'], row['latency']['min'],
+                      row['latency']['p50'], row['latency']['p90'], row['latency']['p99'], row['latency']['max'])
+        elif row['verdict'] == 'stray':
+            print "%s%s  %-10s (sid: %s, %s)" % (prefix, row['call'], row['verdict'], row['sids'][0], row['status'])
+        else:
+            print "%s%s  %-10s %-20s -> %-20s latency: %s (sids: %s)" % (prefix, row['handoff'], row['verdict'], row['from'], row['to'],
+                  row['latency'], ", ".join(row['sids']) or "-")
+
+################################################################################
+def audit_settings(late=None):
+    """ The [audit] matching settings: (late seconds, before and after timedeltas) """
+
+    return (60 * float(late if late is not None else conf_get('audit', 'late', 5)),
+            datetime.timedelta(minutes=int(conf_get('audit', 'before', 15))),
+            datetime.timedelta(minutes=int(conf_get('audit', 'after',  60))))
+
+################################################################################
+def cmd_audit(options):
+    """ 'audit' subcommand: derive every handoff of the --since/--until range from the PagerDuty schedule, match them with
+        the Twilio records of the calls to Phone_Ctlr and report the missed, late and duplicated switchovers, for every
+        team (or --team). Both sides are streamed: memory does not grow with the range. With --stub, the range is first
+        switched over against the simulation stubs (see cmd_simulate), then audited through them: offline, in seconds """
+
+    since = parse_timestamp(options.since)
+    until = parse_timestamp(options.until)
+    late, before, after = audit_settings(options.late)
+
+    if options.stub:
+        schedules = simulation_schedules(options, since - before, until + after)
+        with simulation(schedules, epoch(since - before), fail_rate=options.fail_rate, seed=options.seed, quiet=not options.debug):
+            simulate(schedules, since, until, workers=conf_get('teams', 'max_workers', 8))
+            output = audit_rows(options, since, until, late, before, after)
     else:
-       #print "%s - Not time to switch yet. %-17s is still on-call. We will check back 5 minutes from now." % (now1_iso, who1)
-        alogger.info( "%-17s is still on-call. We will check back 5 minutes from now." % who1 )
+        output = audit_rows(options, since, until, late, before, after)
+
+    if options.json:
+        print json.dumps(output, sort_keys=True, indent=2)
+    else:
+        print_audit(output)
+    return any(row.get('summary') and row['missed'] + row['late'] + row['duplicated'] for row in output) and 1 or 0
+
+################################################################################
+def audit_rows(options, since, until, late, before, after):
+    """ The audit rows of every team (or --team): its handoffs from the PagerDuty schedule and its Phone_Ctlr call
+        records from Twilio, streamed through audit_team() """
+
+    output = []
+    for team in teams:
+        if options.team and team.name != options.team:
+            continue
+        context.team = team
+        ### The windows of the handoffs on the edges of the range reach out of it: so do the schedule and the calls ...
+        handoffs = iter_handoffs((entry_shift(entry) for entry in iter_pd_entries(team.schedule_id, since - before, until + before, options.debug)), since)
+        records  = iter_call_records(team.ctlr_number, since - before, until + after,
+                                     conf_get('audit', 'batch_days', 7), int(conf_get('audit', 'workers', 4)))
+        output.extend(audit_team(team, handoffs, records, since, until, late, before, after, options.verbose))
+    return output
+
+################################################################################
+class OnCallStore(object):
+    """ In-memory shift indexes of every team, covering 'past' hours back and 'horizon' hours ahead,
+        rebuilt in the background so lookups never wait on PagerDuty """
+
+    def __init__(self, teams, past=24, horizon=168):
+        self.teams     = teams
+        self.past      = datetime.timedelta(hours=+int(past))
+        self.horizon   = datetime.timedelta(hours=+int(horizon))
+        self.indexes   = {}     ### team name -> ShiftIndex (the dict is swapped as a whole on refresh) ...
+        self.refreshed = None
+
+    def refresh(self):
+        """ Rebuild the indexes of all teams. A team which cannot be refreshed keeps its previous index """
+        now1    = datetime.datetime.now(tzlocal())
+        indexes = dict(self.indexes)
+        for team in self.teams:
+            try:
+                indexes[team.name] = get_shift_index(team.schedule_id, now1 - self.past, now1 + self.horizon, args.debug)
+            except BaseException, e:    ### sys.exit() included ...
+                alogger.error( "%sError - Unable to refresh the on-call index: %s %s" % (team.tag, Exception, e) )
+        self.indexes   = indexes
+        self.refreshed = now1
+
+    def run(self, every, changed):
+        """ Refresh the indexes every 'every' minutes, or as soon as the 'changed' event is set (background thread) """
+        while True:
+            changed.wait(int(every) * 60)
+            changed.clear()
+            self.refresh()
+
+    def lookup(self, team_name=None):
+        """ [(team, ShiftIndex), ...] of the requested team (all teams by default) """
+        return [(team, self.indexes.get(team.name)) for team in self.teams
+                if self.indexes.get(team.name) is not None and (team_name is None or team.name == team_name)]
+
+################################################################################
+def shift_json(shift):
+    """ JSON-able view of a Shift """
+
+    return shift and {'user_id': shift.user_id, 'name': shift.name, 'start': shift.start.isoformat(), 'end': shift.end.isoformat()}
+
+################################################################################
+def route_oncall(query):
+    """ GET /oncall[?at=<timestamp>][&team=<name>]: who is on call now (or at the given time) """
+
+    ts = parse_timestamp(query.get('at'))
+    return 200, [dict(team=team.name, at=ts.isoformat(), shift=shift_json(index.at(ts))) for team, index in store.lookup(query.get('team'))]
+
+################################################################################
+def route_next(query):
+    """ GET /next[?team=<name>]: the next handoff of each team """
+
+    now1   = datetime.datetime.now(tzlocal())
+    result = []
+    for team, index in store.lookup(query.get('team')):
+        handoffs = index.handoffs(now1, now1 + store.horizon)
+        result.append(dict(team=team.name, handoff=handoffs and handoffs[0][0].isoformat() or None,
+                           leaving=handoffs and shift_json(handoffs[0][1]) or None, entering=handoffs and shift_json(handoffs[0][2]) or None))
+    return 200, result
+
+################################################################################
+def webhook_changes(payload):
+    """ [(schedule id, ts_in, ts_out), ...] changed by a PagerDuty webhook payload (a single 'event', or a list of
+        'messages'). ts_in/ts_out are the override window, None/None when the whole schedule may have changed """
+
+    changes = []
+    for event in payload.get('messages') or [payload.get('event') or payload]:
+        kind = event.get('event_type') or event.get('event') or event.get('type') or ''
+        data = event.get('data') or {}
+        if not kind.startswith(('schedule', 'override')):
+            continue
+        schedId = (data.get('schedule') or {}).get('id') or (kind.startswith('schedule') and data.get('id'))
+        if not schedId:
+            continue
+        ts_in  = data.get('start') and parse_timestamp(data.get('start'))
+        ts_out = data.get('end')   and parse_timestamp(data.get('end'))
+        changes.append((schedId, ts_in or None, ts_out or None))
+    return changes
+
+################################################################################
+def webhook_signature(secret, body):
+    """ PagerDuty-style signature of a webhook body: 'v1=' + hex HMAC-SHA256 """
+
+    return 'v1=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+################################################################################
+def route_webhook(query, body, headers):
+    """ POST /webhook: PagerDuty schedule/override events. Invalidate the changed window of the schedule cache
+        and wake up the daemon (or the lookup server) watching that schedule """
+
+    secret = conf_get('webhook', 'secret')
+    if secret:
+        signatures = (headers.getheader('X-PagerDuty-Signature') or '').split(',')
+        expected   = webhook_signature(secret, body)
+        if not any(hmac.compare_digest(expected, signature.strip()) for signature in signatures):
+            alogger.warning( "Warning - Webhook with a bad signature ignored" )
+            return 401, {'error': "Bad signature"}
+
+    changes = [change for change in webhook_changes(json.loads(body)) if change[0] in wakeups]
+    for schedId, ts_in, ts_out in changes:
+        alogger.info( "Webhook: schedule %s changed (%s -> %s)" % (schedId, ts_in or "*", ts_out or "*") )
+        if cache is not None:
+            cache.invalidate(schedId, ts_in, ts_out)
+        for event in wakeups[schedId]:
+            event.set()
+    return 202, {'changes': len(changes)}
+
+################################################################################
+class AgentRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Local HTTP endpoint of the agent: dispatches GET/POST paths to the functions of 'routes', which take the
+        query parameters (and the request body for POST) and return (status, JSON-able payload) """
+
+    protocol_version = 'HTTP/1.1'   ### Keep-alive: callers with high request rates reuse their connection ...
+    routes           = {('POST', '/webhook'): route_webhook, ('GET', '/metrics'): route_metrics}
+
+    def dispatch(self, method):
+        path, _, qs = self.path.partition('?')
+        query = dict((k, v[-1]) for k, v in urlparse.parse_qs(qs).items())
+        route = self.routes.get((method, path))
+        allow = sorted(m for m, p in self.routes if p == path)
+        try:
+            length = int(self.headers.getheader('Content-Length') or 0)
+        except ValueError:
+            length = None
+        if length < 0:      ### rfile.read() would read until EOF, holding the thread on a kept-alive connection ...
+            length = None
+        ### Read the body whatever the answer: left unread, it would be taken for the next request of the connection ...
+        data = length and self.rfile.read(length) or ''
+        try:
+            if length is None:
+                self.close_connection = 1   ### No telling where the body ends ...
+                status, payload = 400, {'error': "Bad Content-Length: %s" % self.headers.getheader('Content-Length')}
+            elif route is None and allow:
+                status, payload = 405, {'error': "Method not allowed: %s %s" % (method, path)}
+            elif route is None:
+                status, payload = 404, {'error': "Unknown path: %s %s" % (method, path)}
+            elif method == 'POST':
+                status, payload = route(query, data, self.headers)
+            else:
+                status, payload = route(query)
+        except Exception, e:
+            status, payload = 400, {'error': "%s" % e}
+
+        body = isinstance(payload, basestring) and payload or json.dumps(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', isinstance(payload, basestring) and 'text/plain' or 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 405:
+            self.send_header('Allow', ", ".join(allow))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def log_message(self, format, *params):
+        if args.debug:
+            clogger.debug( "HTTP %s - %s" % (self.client_address[0], format % params) )
+
+class AgentHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+################################################################################
+def start_http_server(bind, port):
+    """ Serve the agent's HTTP endpoint on bind:port from a background thread """
+
+    server = AgentHTTPServer((bind, int(port)), AgentRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    alogger.info( "Listening on http://%s:%s/" % (bind, port) )
+    return server
+
+################################################################################
+def cmd_serve(options):
+    """ 'serve' subcommand: answer on-call lookups from memory over localhost HTTP, refreshing in the background """
+
+    global store
+    store = OnCallStore(teams, conf_get('server', 'past', 24), options.horizon or conf_get('server', 'horizon', 168))
+    store.refresh()
+    AgentRequestHandler.routes.update({('GET', '/oncall'): route_oncall, ('GET', '/next'): route_next})
+
+    changed   = watch([team.schedule_id for team in teams])
+    refresher = threading.Thread(target=store.run, args=(options.refresh or conf_get('server', 'refresh', 15), changed))
+    refresher.daemon = True
+    refresher.start()
+
+    start_http_server(options.bind or conf_get('server', 'bind', '127.0.0.1'), options.port or conf_get('server', 'port', 8642))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        alogger.info( "Server stopped." )
+    return 0
+
+################################################################################
+def cmd_webhook(options):
+    """ 'webhook' subcommand: stub PagerDuty sender, posting a (signed) schedule override event to the local receiver """
+
+    schedId = options.schedule or teams[0].schedule_id
+    data    = {'schedule': {'id': schedId, 'type': 'schedule_reference'}}
+    if options.start:
+        data['start'] = parse_timestamp(options.start).isoformat()
+    if options.end:
+        data['end']   = parse_timestamp(options.end).isoformat()
+    body    = json.dumps({'event': {'event_type': 'override.created', 'occurred_at': parse_timestamp('now').isoformat(), 'data': data}})
+
+    headers = {'Content-Type': 'application/json'}
+    if conf_get('webhook', 'secret'):
+        headers['X-PagerDuty-Signature'] = webhook_signature(conf_get('webhook', 'secret'), body)
+    url = options.url or "http://%s:%s/webhook" % (conf_get('server', 'bind', '127.0.0.1'), conf_get('server', 'port', 8642))
+
+    r = requests.post(url, data=body, headers=headers, timeout=10)
+    print "%s %s" % (r.status_code, r.text)
+    return r.status_code == 202 and 0 or 1
+
+################################################################################
+class StubResponse(object):
+    """ What the PagerDuty client reads of a requests.Response """
+
+    def __init__(self, content, status_code=200):
+        self.content     = content
+        self.status_code = status_code
+        self.headers     = {}
+
+################################################################################
+class StubPagerDuty(object):
+    """ Local stand-in of the PagerDuty client for simulations: serves the entries of {schedule id: [entry, ...]}
+        (recorded or synthetic) from memory, paginated like the API, and counts the requests """
+
+    def __init__(self, schedules, page_size=100, chunk=86400, workers=4):
+        self.base_url  = "stub://pagerduty"
+        self.page_size = page_size
+        self.chunk     = chunk
+        self.workers   = workers
+        self.requests  = 0
+        self.schedules = {}
+        for schedId, entries in schedules.items():
+            shifts = sorted(zip(parse_epochs(e.get('start') for e in entries), parse_epochs(e.get('end') for e in entries), entries))
+            self.schedules[schedId] = ([shift[2] for shift in shifts], [shift[0] for shift in shifts], [shift[1] for shift in shifts])
+
+    def get(self, url, budget=None, **kwargs):
+        """ GET /schedules/<id>/entries?since=...&until=...&offset=...&limit=... """
+        self.requests += 1
+        url     = urlparse.urlparse(url)
+        query   = urlparse.parse_qs(url.query)
+        entries, starts, ends = self.schedules.get(url.path.split('/')[-2], ([], [], []))
+        since   = iso_epoch(query['since'][0].replace(' ', '+'))    ### The '+' of the UTC offsets comes unquoted ...
+        until   = iso_epoch(query['until'][0].replace(' ', '+'))
+        offset  = int(query.get('offset', [0])[0])
+        limit   = int(query.get('limit', [self.page_size])[0])
+        first   = bisect.bisect_right(ends, since)
+        last    = bisect.bisect_left(starts, until)
+        return StubResponse(json.dumps({'entries': entries[first + offset:min(last, first + offset + limit)], 'offset': offset,
+                                        'limit': limit, 'total': max(0, last - first), 'more': first + offset + limit < last}))
+
+################################################################################
+class StubCall(object):
+    """ A call placed through StubTwilio: it lasts 'duration' seconds of the virtual clock, then ends with 'outcome' """
+
+    def __init__(self, sid, to, from_, start_time, duration, outcome, send_digits=None):
+        self.sid         = sid
+        self.to          = to
+        self.from_       = from_
+        self.start_time  = start_time
+        self.duration    = duration
+        self.outcome     = outcome
+        self.send_digits = send_digits
+        self.status      = 'queued'
+
+class StubCalls(object):
+    """ The calls resource of StubTwilio. A 'fail_rate' share of the calls fail (drawn from the seeded 'rng') """
+
+    def __init__(self, clock, seconds=12, fail_rate=0.0, rng=None):
+        self.clock     = clock
+        self.seconds   = seconds
+        self.fail_rate = fail_rate
+        self.rng       = rng or random.Random(0)
+        self.lock      = threading.Lock()
+        self.placed    = []
+        self.by_sid    = {}
+
+    def create(self, to, from_, url=None, timeout=None, send_digits=None, **kwargs):
+        with self.lock:
+            call = StubCall("CA%032x" % len(self.placed), to, from_, self.clock.now(tzutc()), self.seconds,
+                            self.rng.random() < self.fail_rate and 'failed' or 'completed', send_digits)
+            self.placed.append(call)
+            self.by_sid[call.sid] = call
+        return call
+
+    def get(self, sid):
+        call = self.by_sid[sid]
+        if self.clock.now(tzutc()) >= call.start_time + datetime.timedelta(seconds=call.duration):
+            call.status = call.outcome
+        else:
+            call.status = 'in-progress'
+        return call
+
+    def iter(self, to=None, started_after=None, started_before=None, **kwargs):
+        for call in list(self.placed):
+            if (to is None or call.to == to) and (started_after is None or call.start_time.date() >= started_after) \
+                                             and (started_before is None or call.start_time.date() <= started_before):
+                yield call
+
+class StubTwilio(object):
+    """ Local stand-in of the Twilio REST client for simulations """
+
+    def __init__(self, clock, seconds=12, fail_rate=0.0, seed=0):
+        self.calls = StubCalls(clock, seconds, fail_rate, random.Random(seed))
+
+class StubSES(object):
+    """ Local stand-in of the SES connection for simulations: keeps the emails it was given """
+
+    def __init__(self):
+        self.sent = []
+
+    def send_email(self, source, subject, body, to_addresses, format=None, html_body=None, **kwargs):
+        self.sent.append((subject, to_addresses, html_body or body))
+
+################################################################################
+def synthetic_schedule(people, ts_in, ts_out, shift_hours=12):
+    """ PagerDuty entries of a rotation of 'people' (Person) in 'shift_hours' shifts on the epoch, over the ts_in/ts_out
+        range plus one shift on each side """
+
+    step    = int(float(shift_hours) * 3600)
+    entries = []
+    for t in xrange(epoch(ts_in) - epoch(ts_in) % step - step, epoch(ts_out) + step, step):
+        i      = (t // step) % len(people)
+        person = people[i]
+        entries.append({'start': datetime.datetime.fromtimestamp(t, tzutc()).isoformat(),
+                        'end':   datetime.datetime.fromtimestamp(t + step, tzutc()).isoformat(),
+                        'user':  {'id': person.user_id or "PSIM%04d" % i, 'name': person.name}})
+    return entries
+
+################################################################################
+def load_schedule(path):
+    """ Recorded PagerDuty entries: a JSON list of entries, or a saved /schedules/<id>/entries response """
+
+    with open(path) as f:
+        content = json.load(f)
+    return isinstance(content, dict) and content.get('entries') or content
+
+################################################################################
+@contextlib.contextmanager
+def simulation(schedules, start, call_seconds=12, fail_rate=0.0, seed=0, quiet=True):
+    """ Run the block against local stubs: PagerDuty serving 'schedules' ({schedule id: entries}), Twilio and SES, on a
+        VirtualClock set to the 'start' epoch, with the journal, schedule cache and alert queue in a scratch directory.
+        Nothing leaves the host. Yield the (clock, pagerduty, client, ses) stubs """
+
+    global clock, pagerduty, client, ses, journal, cache, alerts, deadline
+    saved   = (clock, pagerduty, client, ses, journal, cache, alerts, deadline, args.test)
+    levels  = [(logger, logger.level) for logger in (alogger, clogger, events)]
+    scratch = tempfile.mkdtemp(prefix='phone_agent_sim.')
+    try:
+        path      = os.path.join(scratch, 'Phone_Agent.db')
+        clock     = VirtualClock(start)
+        pagerduty = StubPagerDuty(schedules, pagerduty.page_size, pagerduty.chunk, pagerduty.workers)
+        client    = StubTwilio(clock, call_seconds, fail_rate, seed)
+        ses       = StubSES()
+        journal   = SwitchJournal(path)
+        cache     = cache and ScheduleCache(path, cache.ttl // 60, cache.bucket // 3600)
+        alerts    = AlertQueue(path, alerts and alerts.interval or 300)
+        deadline  = Deadline(None)
+        args.test = False   ### Calls go to the stubs ...
+        if quiet:
+            for logger, level in levels:
+                logger.setLevel(logging.WARNING)
+        yield clock, pagerduty, client, ses
+    finally:
+        clock, pagerduty, client, ses, journal, cache, alerts, deadline, args.test = saved
+        for logger, level in levels:
+            logger.setLevel(level)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+################################################################################
+def simulate(schedules, ts_in, ts_out, every=300, all_runs=False, workers=8):
+    """ Drive the cron runs of every team (run_teams) from ts_in to ts_out on the virtual clock, one every 'every' seconds.
+        Unless 'all_runs', only the runs whose lookahead window holds a handoff are made: the others find the same person
+        twice and do nothing. Return [(run epoch, wall seconds, calls placed), ...] """
+
+    window = int(args.lookahead) * 60
+    t_in   = epoch(ts_in) - window + (every - (epoch(ts_in) - window) % every) % every    ### First run catching the first handoff ...
+    t_out  = epoch(ts_out) + window     ### ... and the last run catching the last one
+    if all_runs:
+        ticks = xrange(t_in, t_out, every)
+    else:
+        ticks = set()
+        for entries in schedules.values():
+            for boundary, leaving, entering in iter_handoffs((entry_shift(entry) for entry in entries), ts_in):
+                b = epoch(boundary)
+                ticks.update(xrange(max(t_in, b - window + (every - (b - window) % every) % every), min(t_out, b + window + 1), every))
+        ticks = sorted(ticks)
+
+    runs = []
+    clock.t = min(clock.t, t_in)
+    for t in ticks:
+        clock.t = max(clock.t, t)   ### Cron starts the run on time, unless the previous one still runs ...
+        placed  = len(client.calls.placed)
+        started = time.time()
+        run_teams(clock.now(tzlocal()), workers)
+        runs.append((t, time.time() - started, len(client.calls.placed) - placed))
+    alerts.flush()
+    return runs
+
+################################################################################
+def simulation_schedules(options, ts_in, ts_out):
+    """ {schedule id: entries} of the teams: the --schedule recording, or a synthetic rotation of each team's directory """
+
+    schedules = {}
+    for team in teams:
+        if options.schedule:
+            schedules[team.schedule_id] = load_schedule(options.schedule)
+        elif len(team.directory.people) < 2:
+            raise ValueError("%sat least two people are needed in the directory for a synthetic rotation" % team.tag)
+        else:
+            schedules[team.schedule_id] = synthetic_schedule(team.directory.people, ts_in, ts_out, options.shift_hours)
+    return schedules
+
+################################################################################
+def simulation_report(schedules, ts_in, ts_out, verbose=False):
+    """ The audit rows of the simulated switchovers: the handoffs of the stub schedules matched with the stub call records """
 
+    late, before, after = audit_settings()
+    output = []
+    for team in teams:
+        handoffs = iter_handoffs((entry_shift(entry) for entry in schedules[team.schedule_id]), ts_in)
+        records  = sorted((call_record(call) for call in client.calls.placed if call.to == team.ctlr_number), key=lambda r: r.start)
+        output.extend(audit_team(team, handoffs, records, ts_in, ts_out, late, before, after, verbose))
+    return output
 
+################################################################################
+def cmd_simulate(options):
+    """ 'simulate' subcommand: replay the --since/--until range against the stub PagerDuty, Twilio and SES on a virtual
+        clock, and report the switchovers (as the audit does), the calls, the emails and the wall time of the runs """
+
+    ts_in  = parse_timestamp(options.since)
+    ts_out = parse_timestamp(options.until)
+    schedules = simulation_schedules(options, ts_in, ts_out)
+
+    started = time.time()
+    with simulation(schedules, epoch(ts_in), options.call_seconds, options.fail_rate, options.seed, not options.debug) as (vclock, stub_pd, stub_tw, stub_ses):
+        runs   = simulate(schedules, ts_in, ts_out, 60 * int(options.every), options.all_runs, conf_get('teams', 'max_workers', 8))
+        output = simulation_report(schedules, ts_in, ts_out, options.verbose)
+        walls  = sorted(seconds for t, seconds, placed in runs)
+        output.append({'team': None, 'simulation': True, 'runs': len(runs), 'wall_seconds': round(time.time() - started, 3),
+                       'run_seconds': walls and {'p50': round(percentile(walls, 50), 4), 'p90': round(percentile(walls, 90), 4),
+                                                 'max': round(walls[-1], 4)},
+                       'calls': len(stub_tw.calls.placed), 'failed_calls': sum(call.outcome != 'completed' for call in stub_tw.calls.placed),
+                       'emails': len(stub_ses.sent), 'pagerduty_requests': stub_pd.requests})
+
+    if options.json:
+        print json.dumps(output, sort_keys=True, indent=2)
+    else:
+        print_audit(row for row in output if not row.get('simulation'))
+        row = output[-1]
+        print "Simulated %s -> %s: %s runs in %ss (per run: p50 %ss, p90 %ss, max %ss), %s calls (%s failed), %s emails, %s PagerDuty requests" % (
+              ts_in.isoformat(), ts_out.isoformat(), row['runs'], row['wall_seconds'], row['run_seconds'] and row['run_seconds']['p50'],
+              row['run_seconds'] and row['run_seconds']['p90'], row['run_seconds'] and row['run_seconds']['max'],
+              row['calls'], row['failed_calls'], row['emails'], row['pagerduty_requests'])
+
+    ### The stub calls carry the digits they sent, so every command is attributed: the agent never repeats a completed
+    ### command, and a duplicated switchover is a false positive of the audit (or a regression of the agent) ...
+    duplicated = sum(row['duplicated'] for row in output if row.get('summary'))
+    if duplicated:
+        clogger.error( "Simulation: %s switchover(s) reported duplicated" % duplicated )
+        return 1
+    return 0
+
+################################################################################
+def bench_parse(count):
+    """ Entries per second through the schedule parsing: JSON decoding, the ShiftIndex and the handoff detection """
+
+    people  = [Person("Bench User%d" % i, "PBENCH%02d" % i, None, None, None) for i in xrange(5)]
+    ts_in   = datetime.datetime(2018, 1, 1, tzinfo=tzutc())
+    content = json.dumps({'entries': synthetic_schedule(people, ts_in, ts_in + datetime.timedelta(hours=12 * (count - 2)), 12)})
+
+    started = time.time()
+    index   = ShiftIndex(json.loads(content)['entries'])
+    index.handoffs(index.shifts[0].start, index.shifts[-1].end)
+    return len(index) / (time.time() - started)
+
+################################################################################
+def bench_baseline(path, results, tolerance):
+    """ Compare the results with the baseline saved in 'path': [(name, value, baseline, change %, regressed), ...]. The
+        '_per_second' results regress when lower, the others when higher, by more than 'tolerance' % """
+
+    with open(path) as f:
+        baseline = json.load(f).get('results', {})
+    rows = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if not base:
+            rows.append((name, value, None, None, False))
+            continue
+        change = 100.0 * (value - base) / abs(base)
+        worse  = name.endswith('_per_second') and -change or change
+        rows.append((name, value, base, round(change, 1), worse > tolerance))
+    return rows
+
+################################################################################
+def cmd_bench(options):
+    """ 'bench' subcommand: time the schedule parsing, the cron runs (idle, and switching over) and the handoff latency
+        on the stubs, and compare them with the saved baseline (or save them as the new baseline) """
+
+    path      = options.baseline or conf_get('bench', 'baseline', '/opt/tools/phone_agent/Phone_Agent.bench.json')
+    tolerance = float(conf_get('bench', 'tolerance', 25))
+    ts_in     = datetime.datetime(2018, 9, 1, tzinfo=tzutc())
+    ts_out    = ts_in + datetime.timedelta(days=int(options.days))
+    options.schedule = None
+    schedules = simulation_schedules(options, ts_in, ts_out)
+
+    results = collections.OrderedDict()
+    results['parse_entries_per_second'] = round(bench_parse(int(options.entries)))
+    with simulation(schedules, epoch(ts_in), options.call_seconds, 0.0, 0, not options.debug):
+        runs   = simulate(schedules, ts_in, ts_out, 300, True, conf_get('teams', 'max_workers', 8))
+        idle   = sorted(seconds for t, seconds, placed in runs if not placed)
+        switch = sorted(seconds for t, seconds, placed in runs if placed)
+        report = [row for row in simulation_report(schedules, ts_in, ts_out) if row.get('latency')]
+    results['run_seconds_p50']             = round(percentile(idle, 50), 5)
+    results['run_seconds_p90']             = round(percentile(idle, 90), 5)
+    results['switch_run_seconds_p50']      = switch and round(percentile(switch, 50), 5)
+    results['handoff_latency_seconds_p50'] = report and max(row['latency']['p50'] for row in report)   ### Virtual: from the boundary to the switch ...
+
+    if options.save_baseline:
+        with open(path, 'w') as f:
+            json.dump({'results': results, 'saved': datetime.datetime.now(tzlocal()).isoformat(), 'host': socket.gethostname(),
+                       'python': sys.version.split()[0], 'runs': len(runs), 'entries': int(options.entries)}, f, indent=2)
+        print "Baseline saved to %s" % path
+
+    rows = os.path.exists(path) and not options.save_baseline and bench_baseline(path, results, tolerance) or \
+           [(name, value, None, None, False) for name, value in results.items()]
+    if options.json:
+        print json.dumps([{'name': name, 'value': value, 'baseline': base, 'change': change, 'regressed': regressed}
+                          for name, value, base, change, regressed in rows], sort_keys=True, indent=2)
+    else:
+        for name, value, base, change, regressed in rows:
+            print "%-30s %14s %14s %8s %s" % (name, value, base is not None and base or "-", change is not None and "%+.1f%%" % change or "",
+                                              regressed and "REGRESSION" or "")
+    return any(regressed for name, value, base, change, regressed in rows) and 1 or 0
+
+COMMANDS = {'oncall': cmd_oncall, 'serve': cmd_serve, 'webhook': cmd_webhook, 'audit': cmd_audit,
+            'simulate': cmd_simulate, 'bench': cmd_bench}
+
+################################################################################
+def setup(options, lock=False):
+    """ Initialize logging, the configuration file, the API clients and the teams from the parsed command line
+        'options'. With 'lock', hold the instance lock and bound the run with the configured deadline """
+
+    global args, email, alogger, clogger, s, deadline, ses, cache, journal, pagerduty, alerts, leader, quiet, planner
+    global apibase, apivers, tw_acct, tw_token, callerid, phone_ctlr_number, client, teams
+
+    args = options
+
+    email = "opsTeam@saasmail.my_company.com"
+
+    ############################################################################
+    ### Read the configuration file ...
+    ############################################################################
+    s = ConfigParser.ConfigParser()
+    s.readfp(open(args.conf_file))
+
+    ############################################################################
+    ### Initialize logging ([logging] section) ...
+    ############################################################################
+    setupLogging()
+
+    alogger = logging.getLogger("phone_ctlr_log")
+    clogger = logging.getLogger("console_log")
+    alogger.setLevel(logging.INFO)
+    clogger.setLevel(logging.INFO)
+    if args.debug:
+        alogger.setLevel(logging.DEBUG)
+        clogger.setLevel(logging.DEBUG)
 
+    ############################################################################
+    ### Only one instance at a time, and a cron run must be over before the next cron tick ...
+    ############################################################################
+    if lock:
+        acquire_lock(conf_get('run', 'lock_file', '/opt/tools/phone_agent/Phone_Agent.lock'))
+    deadline = Deadline(conf_get('run', 'deadline', 240) if lock and not args.daemon else None)
+
+    ############################################################################
+    ### HA: the agents of several hosts share a lease, only its holder switches Phone_Ctlr over. The journal and the
+    ### alert queue are shared too, so that a new leader neither repeats nor drops a handoff ...
+    ############################################################################
+    shared = None
+    if conf_get('ha', 'enabled', 'false').lower() in ('true', 'yes', 'on', '1'):
+        backend = conf_get('ha', 'backend', 'sqlite')
+        path    = conf_get('ha', 'path', '/opt/tools/phone_agent/Phone_Agent.db')
+        shared  = conf_get('ha', 'journal', backend == 'sqlite' and path or None)
+        if shared is None and backend != 'local':   ### A local journal would let a new leader repeat or drop a handoff ...
+            alogger.error( "Error - [ha] journal must be set to a file shared by the hosts with the '%s' backend" % backend )
+            sys.exit(2)
+        if lock:
+            leader = LeaderElection(lease_backend(backend, path), conf_get('ha', 'lease', 'phone_agent'),
+                                    conf_get('ha', 'node', "%s:%s" % (socket.gethostname(), os.getpid())),
+                                    conf_get('ha', 'ttl', 15), conf_get('ha', 'heartbeat', 5))
+            leader.callbacks.append(wake_daemons)
+            leader.beat()
+            leader.start()
+            atexit.register(leader.stop)
+
+    startup.mark("logging, configuration and lock")
+
+    if lock:    ### The cron runs and the daemon add their metrics to the textfile on exit ...
+        atexit.register(save_metrics)
+
+    ses = Lazy(lambda: boto.connect_ses(s.get("awsprod", "access_key"), s.get("awsprod", "secret_key")), "SES connection")  # Establish a boto session (on the first email) ...
+
+    ############################################################################
+    ### Alert emails go through the durable queue, sent as rate-limited digests in the background ...
+    ############################################################################
+    alerts = AlertQueue(shared or conf_get('alerts', 'path', '/opt/tools/phone_agent/Phone_Agent.db'), conf_get('alerts', 'interval', 300))
+    alerts.start()
+    atexit.register(alerts.close)
+
+    ############################################################################
+    ### Open the on-disk schedule cache ...
+    ############################################################################
+    cache = None
+    if conf_get('cache', 'enabled', 'true').lower() in ('true', 'yes', 'on', '1'):
+        cache = ScheduleCache(conf_get('cache', 'path',   '/opt/tools/phone_agent/Phone_Agent.db'),
+                              conf_get('cache', 'ttl',    30),
+                              conf_get('cache', 'bucket', 6))
+
+    ############################################################################
+    ### Open the switchover journal ...
+    ############################################################################
+    journal = SwitchJournal(shared or conf_get('journal', 'path', '/opt/tools/phone_agent/Phone_Agent.db'))
+    startup.mark("schedule cache and journal")
+
+    ############################################################################
+    ### PagerDuty API client (pooled connections, timeouts, retries) ...
+    ############################################################################
+    pagerduty = PagerDutyClient(conf_get('pagerduty', 'url',   "https://my_company.pagerduty.com/api/v1"),
+                                (conf_get('pagerduty', 'user',  'pagerdutyapiuser@my_company.com'),
+                                 conf_get('pagerduty', 'token', 'my_company12345678')),     # my_company12345678 => PD-Token
+                                conf_get('pagerduty', 'connect_timeout', 5),
+                                conf_get('pagerduty', 'read_timeout',    20),
+                                conf_get('pagerduty', 'attempts',        5),
+                                conf_get('pagerduty', 'backoff',         1),
+                                conf_get('pagerduty', 'max_backoff',     30),
+                                page_size     = conf_get('pagerduty', 'page_size',     100),
+                                chunk_hours   = conf_get('pagerduty', 'chunk_hours',   24),
+                                fetch_workers = conf_get('pagerduty', 'fetch_workers', 4))
+
+    ############################################################################
+    #-- Twilio REST API version ...
+    ############################################################################
+    apibase = "https://api.twilio.com/"
+    apivers = "2010-04-01"
+
+    ############################################################################
+    ### Read the Twilio credentials ...
+    ############################################################################
+    tw_acct  = s.get('twilio', 'account')
+    tw_token = s.get('twilio', 'token')
+
+    ############################################################################
+    #-- Outgoing Caller ID you have previously validated with Twilio ...
+    ############################################################################
+    callerid           = "+18005551212"    # My_Company originating phone number - Twilio verified ...
+    phone_ctlr_number  = "+18005551212"    # Phone_Ctlr phone number to hit to en/disable Phone_Ctlr remotely - Twilio verified ...
+
+    ############################################################################
+    ### The teams to look after: one PagerDuty schedule, Phone_Ctlr number and phone directory each ...
+    ############################################################################
+    teams = load_teams()
+    load_directories(teams)
+
+    ############################################################################
+    ### Quiet hours: when the switchovers skip enabling and calling the people ...
+    ############################################################################
+    quiet = QuietHours(conf_get('quiet_hours', 'timezone', 'US/Pacific'),
+                       conf_get('quiet_hours', 'passive',  '22:46-07:00'),
+                       conf_get('quiet_hours', 'exiting',  '07:00-07:15'))
+
+    ############################################################################
+    ### Handoffs planned (and validated) up to [planner] hours ahead of time ...
+    ############################################################################
+    planner = HandoffPlanner(conf_get('planner', 'hours', 8))
+    startup.mark("API clients and teams")
+
+    ############################################################################
+    ### Let's run everything localized ...
+    ############################################################################
+    os.environ["TZ"] = "PST8PDT"
+    time.tzset()
+    if args.debug: clogger.debug( "Current: %s" % datetime.datetime.now(tzlocal()).strftime('%Y-%m-%dT%H:%M:%S%z') )   # Display localized system's datetime.
+
+    ############################################################################
+    #-- Instantiate a new Twilio Rest Client (on the first call) ...
+    ############################################################################
+    client = Lazy(lambda: twilio.rest.TwilioRestClient(account=tw_acct, token=tw_token, base=apibase, version=apivers), "Twilio client")
+
+
+#################
+##    MAIN
+#################
+
+if __name__ == '__main__':
+
+    VERSION='0.1'
+
+    parser = argparse.ArgumentParser(description = "Phone Line Redirector for Phone_Ctlr", add_help=True, version=VERSION)
+    parser.add_argument('conf_file',       action='store',      default="Phone_Agent.conf",    help = "Phone extension conf file")
+    parser.add_argument('start_datetime',  action='store',                     help = "Begining of coverage")
+    parser.add_argument('end_datetime',    action='store',                     help = "End of coverage")
+    parser.add_argument('--verbose',       action='store_true', default=False, help = "Show verbose output")
+    parser.add_argument('-l', '--lookahead',  action='store',      default=int(8),help = "Lookahead before and after current time")
+    parser.add_argument('-d', '--debug',   action='store_true', default=False, help = "Show debug info")
+    parser.add_argument('-t', '--test',    action='store_true', default=False, help = "Test mode - Does not call out")
+    parser.add_argument('-D', '--daemon',  action='store_true', default=False, help = "Stay resident and wake up at each handoff instead of running from cron")
+    parser.add_argument('--refresh',       action='store',      default=None,   help = "Daemon mode: minutes between two schedule refreshes (default: 60, [webhook] poll with the webhook)")
+    parser.add_argument('--horizon',       action='store',      default=int(24),help = "Daemon mode: hours of schedule to look ahead on each refresh")
+    parser.add_argument('--profile-startup', action='store_true', default=False, help = "Report the time spent in each import and init phase on exit")
+   #parser.add_argument('-V', '--version', action='version',   version='%(prog)s: 1.0')
+
+    ############################################################################
+    ### Subcommands (the first argument), next to the historical cron invocation ...
+    ############################################################################
+    tools = argparse.ArgumentParser(description = "Phone Line Redirector for Phone_Ctlr -- tools", add_help=True, version=VERSION)
+    subparsers = tools.add_subparsers(dest='command')
+
+    oncall_cmd = subparsers.add_parser('oncall', help = "Who is on call at given times, over a range, and the handoffs in that range")
+    oncall_cmd.add_argument('conf_file',       action='store',                     help = "Phone extension conf file")
+    oncall_cmd.add_argument('--at',            action='append',     default=[],    help = "Timestamp to resolve (repeatable)")
+    oncall_cmd.add_argument('--since',         action='store',      default=None,  help = "Beginning of the range to list")
+    oncall_cmd.add_argument('--until',         action='store',      default=None,  help = "End of the range to list")
+    oncall_cmd.add_argument('--handoffs',      action='store_true', default=False, help = "List the handoffs of the range instead of the shifts")
+    oncall_cmd.add_argument('--team',          action='store',      default=None,  help = "Team name (default: all teams)")
+    oncall_cmd.add_argument('--json',          action='store_true', default=False, help = "JSON output")
+    oncall_cmd.add_argument('-d', '--debug',   action='store_true', default=False, help = "Show debug info")
+
+    audit_cmd = subparsers.add_parser('audit', help = "Reconcile the handoffs of a range with the Twilio records of the Phone_Ctlr calls")
+    audit_cmd.add_argument('conf_file',       action='store',                     help = "Phone extension conf file")
+    audit_cmd.add_argument('--since',         action='store',      required=True, help = "Beginning of the range to audit")
+    audit_cmd.add_argument('--until',         action='store',      default='now', help = "End of the range to audit")
+    audit_cmd.add_argument('--late',          action='store',      default=None,  help = "Minutes after the handoff a switchover is late ([audit] late)")
+    audit_cmd.add_argument('--team',          action='store',      default=None,  help = "Team name (default: all teams)")
+    audit_cmd.add_argument('--json',          action='store_true', default=False, help = "JSON output")
+    audit_cmd.add_argument('--verbose',       action='store_true', default=False, help = "Also list the handoffs switched on time and the stray calls")
+    audit_cmd.add_argument('--stub',          action='store_true', default=False, help = "Switch the range over against the simulation stubs, then audit them (offline)")
+    audit_cmd.add_argument('--schedule',      action='store',      default=None,  help = "--stub: recorded schedule entries (JSON) instead of a synthetic rotation")
+    audit_cmd.add_argument('--shift-hours',   action='store',      default=12,    help = "--stub: shift length of the synthetic rotation")
+    audit_cmd.add_argument('--fail-rate',     action='store',      default=0.0,   type=float, help = "--stub: share of the stub calls which fail")
+    audit_cmd.add_argument('--seed',          action='store',      default=0,     type=int,   help = "--stub: seed of the stub call failures")
+    audit_cmd.add_argument('-l', '--lookahead', action='store',    default=8,     help = "--stub: lookahead before and after the run time")
+    audit_cmd.add_argument('-d', '--debug',   action='store_true', default=False, help = "Show debug info")
+
+    simulate_cmd = subparsers.add_parser('simulate', help = "Replay a range of handoffs against stub PagerDuty, Twilio and SES on a virtual clock")
+    simulate_cmd.add_argument('conf_file',      action='store',                      help = "Phone extension conf file")
+    simulate_cmd.add_argument('--since',        action='store',      required=True,  help = "Beginning of the simulated range")
+    simulate_cmd.add_argument('--until',        action='store',      required=True,  help = "End of the simulated range")
+    simulate_cmd.add_argument('--schedule',     action='store',      default=None,   help = "Recorded schedule entries (JSON) instead of a synthetic rotation")
+    simulate_cmd.add_argument('--shift-hours',  action='store',      default=12,     help = "Shift length of the synthetic rotation")
+    simulate_cmd.add_argument('--every',        action='store',      default=5,      help = "Minutes between two cron runs")
+    simulate_cmd.add_argument('--all-runs',     action='store_true', default=False,  help = "Also make the runs without any handoff in their lookahead window")
+    simulate_cmd.add_argument('--call-seconds', action='store',      default=12,     type=float, help = "Duration of every stub call")
+    simulate_cmd.add_argument('--fail-rate',    action='store',      default=0.0,    type=float, help = "Share of the stub calls which fail")
+    simulate_cmd.add_argument('--seed',         action='store',      default=0,      type=int,   help = "Seed of the stub call failures")
+    simulate_cmd.add_argument('-l', '--lookahead', action='store',   default=8,      help = "Lookahead before and after the run time")
+    simulate_cmd.add_argument('--json',         action='store_true', default=False,  help = "JSON output")
+    simulate_cmd.add_argument('--verbose',      action='store_true', default=False,  help = "Also list the handoffs switched on time and the stray calls")
+    simulate_cmd.add_argument('-d', '--debug',  action='store_true', default=False,  help = "Show debug info (and the logs of the runs)")
+
+    bench_cmd = subparsers.add_parser('bench', help = "Benchmark the schedule parsing, the runs and the handoff latency on the stubs")
+    bench_cmd.add_argument('conf_file',         action='store',                      help = "Phone extension conf file")
+    bench_cmd.add_argument('--entries',         action='store',      default=20000,  help = "Schedule entries to parse")
+    bench_cmd.add_argument('--days',            action='store',      default=2,      help = "Days of cron runs (every 5 minutes) to time")
+    bench_cmd.add_argument('--shift-hours',     action='store',      default=12,     help = "Shift length of the synthetic rotation")
+    bench_cmd.add_argument('--call-seconds',    action='store',      default=12,     type=float, help = "Duration of every stub call")
+    bench_cmd.add_argument('--baseline',        action='store',      default=None,   help = "Baseline file ([bench] baseline)")
+    bench_cmd.add_argument('--save-baseline',   action='store_true', default=False,  help = "Save the results as the new baseline")
+    bench_cmd.add_argument('-l', '--lookahead', action='store',      default=8,      help = "Lookahead before and after the run time")
+    bench_cmd.add_argument('--json',            action='store_true', default=False,  help = "JSON output")
+    bench_cmd.add_argument('-d', '--debug',     action='store_true', default=False,  help = "Show debug info (and the logs of the runs)")
+
+    serve_cmd = subparsers.add_parser('serve', help = "Serve on-call lookups (/oncall, /next) over localhost HTTP")
+    serve_cmd.add_argument('conf_file',    action='store',                     help = "Phone extension conf file")
+    serve_cmd.add_argument('--bind',       action='store',      default=None,   help = "Address to listen on ([server] bind)")
+    serve_cmd.add_argument('--port',       action='store',      default=None,   help = "Port to listen on ([server] port)")
+    serve_cmd.add_argument('--refresh',    action='store',      default=None,   help = "Minutes between two refreshes of the schedules ([server] refresh)")
+    serve_cmd.add_argument('--horizon',    action='store',      default=None,   help = "Hours of schedule to keep ahead ([server] horizon)")
+    serve_cmd.add_argument('-d', '--debug', action='store_true', default=False, help = "Show debug info")
+
+    webhook_cmd = subparsers.add_parser('webhook', help = "Send a test schedule override event to the local webhook receiver")
+    webhook_cmd.add_argument('conf_file',  action='store',                     help = "Phone extension conf file")
+    webhook_cmd.add_argument('--schedule', action='store',      default=None,   help = "PagerDuty schedule id (default: the first team's)")
+    webhook_cmd.add_argument('--start',    action='store',      default=None,   help = "Start of the override (default: the whole schedule)")
+    webhook_cmd.add_argument('--end',      action='store',      default=None,   help = "End of the override")
+    webhook_cmd.add_argument('--url',      action='store',      default=None,   help = "Receiver URL (default: [server] bind/port)")
+    webhook_cmd.add_argument('-d', '--debug', action='store_true', default=False, help = "Show debug info")
+
+    if len(sys.argv) > 1 and sys.argv[1] in subparsers.choices:
+        args = tools.parse_args()
+        args.test = True    ### Tools never call out ...
+        setup(args)
+        sys.exit(COMMANDS[args.command](args))
+
+    args = parser.parse_args()
+    startup.mark("module definitions and command line")
+    if args.profile_startup:
+        atexit.register(startup.report)
+
+    setup(args, lock=True)
+
+    if leader is not None and not args.daemon and not leader.leading():
+        alogger.info( "HA standby: another agent holds the lease, nothing to do." )
+        sys.exit(0)
+
+    now1 = parse_timestamp(args.start_datetime) # First command line argument ('now', '0' or empty: the current time) ...
+
+    ############################################################################
+    ### Handle all the teams concurrently: the wall time tracks the slowest team ...
+    ############################################################################
+    workers = conf_get('teams', 'max_workers', 8)
+
+    if args.daemon:
+        ########################################################################
+        ### With the webhook receiver on, schedule changes are pushed: polling is only a slow safety net ...
+        ########################################################################
+        webhook = conf_get('webhook', 'enabled', 'false').lower() in ('true', 'yes', 'on', '1')
+        if webhook or conf_get('metrics', 'listen', 'false').lower() in ('true', 'yes', 'on', '1'):
+            start_http_server(conf_get('server', 'bind', '127.0.0.1'), conf_get('server', 'port', 8642))   ### /webhook and /metrics ...
+        if webhook:
+            args.refresh = args.refresh or conf_get('webhook', 'poll', 360)
+        args.refresh = args.refresh or 60
+        try:
+            run_parallel(run_daemon, teams, len(teams))
+        except KeyboardInterrupt:
+            alogger.info( "Daemon stopped." )
+    else:
+        exit_code = run_teams(now1, workers)
+        if planner.hours and deadline.allows(PLAN_MIN + ALERT_RESERVE):
+            plan_teams(now1, workers)
+        sys.exit(exit_code)
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+################################################################################
+### Checks of Phone_agent.py: unit checks of the schedule and quiet hours logic, and the simulated switchovers of a
+### range of handoffs against the local stubs (nothing leaves the host). Run them with:
+###     python -m unittest -v test_Phone_agent
+################################################################################
+import  os, sys, json, shutil, tempfile, argparse, datetime, subprocess, unittest
+
+HERE  = os.path.dirname(os.path.abspath(__file__))
+AGENT = os.path.join(HERE, 'Phone_agent.py')
+sys.path.insert(0, HERE)
+
+import  Phone_agent as agent
+
+################################################################################
+def scratch_conf(scratch):
+    """ The sample config file, with its files (log, journal, cache, lock, ...) in the 'scratch' directory """
+
+    with open(os.path.join(HERE, 'Phone_agent.conf')) as f:
+        content = f.read().replace('/opt/tools/phone_agent', scratch)
+    path = os.path.join(scratch, 'Phone_agent.conf')
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+def utc(*fields):
+    return datetime.datetime(*fields, tzinfo=agent.tzutc())
+
+def entries(*shifts):
+    """ PagerDuty entries of (start, end, user id) shifts """
+    return [{'start': start, 'end': end, 'user': {'id': uid, 'name': "User %s" % uid}} for start, end, uid in shifts]
+
+################################################################################
+class ParseEpochsTest(unittest.TestCase):
+
+    STAMPS = ['2018-09-14T05:00:00-07:00', '2018-09-14T12:00:00Z', '2018-09-14T12:00:00+00:00', '2018-09-14 12:00:00.5+00:00',
+              '2018-03-11T03:30:00-07:00', '2018-11-04T01:30:00-08:00']
+
+    def test_small_batch(self):
+        self.assertEqual(list(agent.parse_epochs(self.STAMPS)), [agent.iso_epoch(ts) for ts in self.STAMPS])
+        self.assertEqual(agent.parse_epochs(self.STAMPS)[0], 1536926400)
+
+    def test_big_batch(self):
+        stamps = self.STAMPS * (agent.BATCH // len(self.STAMPS) + 1)
+        self.assertEqual([int(t) for t in agent.parse_epochs(stamps)], [agent.iso_epoch(ts) for ts in stamps])
+
+    def test_empty(self):
+        self.assertEqual(list(agent.parse_epochs([])), [])
+
+################################################################################
+class E164Test(unittest.TestCase):
+
+    def test_north_american(self):
+        self.assertEqual(agent.e164('(408) 555-1212'), '+14085551212')
+        self.assertEqual(agent.e164('1-408-555-1212'), '+14085551212')
+        self.assertEqual(agent.e164(4085551212), '+14085551212')
+
+    def test_international(self):
+        self.assertEqual(agent.e164('+33 1 23 45 67 89'), '+33123456789')
+
+    def test_invalid(self):
+        self.assertEqual(agent.e164('555-1212'), None)
+        self.assertEqual(agent.e164('+12'), None)
+        self.assertEqual(agent.e164('none'), None)
+
+################################################################################
+class ShiftIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = agent.ShiftIndex(entries(('2018-09-14T12:00:00Z', '2018-09-15T00:00:00Z', 'PB'),
+                                              ('2018-09-14T00:00:00Z', '2018-09-14T12:00:00Z', 'PA'),
+                                              ('2018-09-14T00:00:00Z', '2018-09-14T12:00:00Z', 'PA'),   ### Seen twice ...
+                                              ('2018-09-15T00:00:00Z', '2018-09-15T12:00:00Z', 'PB'),
+                                              ('2018-09-15T13:00:00Z', '2018-09-16T00:00:00Z', 'PA')))
+
+    def test_at(self):
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.index.at(utc(2018, 9, 14, 11, 59)).user_id, 'PA')
+        self.assertEqual(self.index.at(utc(2018, 9, 14, 12)).user_id, 'PB')
+        self.assertEqual(self.index.at(utc(2018, 9, 15, 12, 30)), None)    ### Gap ...
+        self.assertEqual(self.index.at(utc(2018, 9, 13)), None)
+
+    def test_between(self):
+        self.assertEqual([shift.user_id for shift in self.index.between(utc(2018, 9, 14, 11), utc(2018, 9, 15, 1))], ['PA', 'PB', 'PB'])
+        self.assertEqual(self.index.between(utc(2018, 9, 17), utc(2018, 9, 18)), [])
+
+    def test_handoffs(self):
+        handoffs = self.index.handoffs(utc(2018, 9, 14), utc(2018, 9, 16))
+        self.assertEqual([(boundary, leaving.user_id, entering.user_id) for boundary, leaving, entering in handoffs],
+                         [(utc(2018, 9, 14, 12), 'PA', 'PB'), (utc(2018, 9, 15, 13), 'PB', 'PA')])
+
+################################################################################
+class QuietHoursTest(unittest.TestCase):
+
+    def setUp(self):
+        self.quiet = agent.QuietHours('US/Pacific', '22:46-07:00', '07:00-07:15')
+
+    def local(self, *fields):
+        return agent.epoch(self.quiet.tz.localize(datetime.datetime(*fields)))
+
+    def test_classify(self):
+        epochs = [self.local(2018, 9, 14, 22, 45), self.local(2018, 9, 14, 22, 46), self.local(2018, 9, 15, 6, 59),
+                  self.local(2018, 9, 15, 7, 0), self.local(2018, 9, 15, 7, 15), self.local(2018, 9, 15, 12)]
+        self.assertEqual(self.quiet.classify(epochs), ['active', 'passive', 'passive', 'exiting', 'active', 'active'])
+
+    def test_dst(self):
+        self.assertEqual(self.quiet.at(self.local(2018, 3, 11, 6, 30)), 'passive')
+        self.assertEqual(self.quiet.at(self.local(2018, 11, 4, 7, 5)), 'exiting')
+
+    def test_big_batch(self):
+        epochs = [self.local(2018, 9, 1) + 600 * i for i in xrange(agent.BATCH * 2)]
+        self.assertEqual(self.quiet.classify(epochs), [self.quiet.classify([t])[0] for t in epochs])
+
+################################################################################
+class JournalTest(unittest.TestCase):
+    """ switchover() skips the steps the journal says were done: only what failed is retried """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch = tempfile.mkdtemp(prefix='phone_agent_test.')
+        agent.setup(argparse.Namespace(conf_file=scratch_conf(cls.scratch), debug=False, test=True, daemon=False, lookahead=8))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.scratch, ignore_errors=True)
+
+    def switch(self, done=()):
+        """ Phone_Ctlr commands sent by a switchover with the 'done' steps in the journal, and whether it completed """
+        team     = agent.teams[0]
+        people   = team.directory.people
+        handoff  = agent.parse_iso('2018-09-14T19:00:00+00:00')    ### Noon in US/Pacific: active on-call ...
+        schedule = {team.schedule_id: agent.synthetic_schedule(people, handoff, handoff)}
+        with agent.simulation(schedule, agent.epoch(handoff)) as (clock, pagerduty, client, ses):
+            key = (team.schedule_id, str(handoff), people[0].name, people[1].name)
+            for step in done:
+                agent.journal.record(key, step, True, 'CA%s' % step)
+            agent.switchover(team, str(handoff), people[0].name, people[1].name)
+            commands = [agent.ctlr_commands(call.send_digits) for call in client.calls.placed if call.to == team.ctlr_number]
+            return commands, agent.journal.done(key, 'switchover')
+
+    def test_all_steps(self):
+        self.assertEqual(self.switch(), ([('enable',), ('disable',)], True))
+
+    def test_enable_done(self):
+        self.assertEqual(self.switch(['enable']), ([('disable',)], True))
+
+    def test_switchover_done(self):
+        self.assertEqual(self.switch(['enable', 'disable', 'switchover']), ([], True))
+
+################################################################################
+class SimulationTest(unittest.TestCase):
+    """ The switchovers of a range of handoffs, replayed against the stubs with failing calls: none missed or duplicated """
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(prefix='phone_agent_test.')
+        self.conf    = scratch_conf(self.scratch)
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def run_agent(self, *options):
+        process = subprocess.Popen([sys.executable, AGENT] + list(options), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        return process.returncode, out, err
+
+    def test_simulate(self):
+        code, out, err = self.run_agent('simulate', self.conf, '--since', '2018-09-01T00:00:00-07:00',
+                                        '--until', '2018-09-15T00:00:00-07:00', '--fail-rate', '0.3', '--json')
+        self.assertEqual(code, 0, err)
+        summaries = [row for row in json.loads(out) if row.get('summary')]
+        self.assertTrue(summaries)
+        for row in summaries:
+            self.assertTrue(row['handoffs'] > 0)
+            self.assertEqual((row['missed'], row['duplicated'], row['stray']), (0, 0, 0), row)
+
+    def test_audit_stub(self):
+        code, out, err = self.run_agent('audit', self.conf, '--stub', '--since', '2018-09-01T00:00:00-07:00',
+                                        '--until', '2018-09-15T00:00:00-07:00', '--json')
+        self.assertEqual(code, 0, err)
+        for row in json.loads(out):
+            self.assertEqual(row['ok'], row['handoffs'], row)
+
+if __name__ == '__main__':
+    unittest.main()